@@ -1,148 +1,2083 @@
 import sys
 import os
+import re
 import json
+import mmap
+import struct
+import hashlib
 import shutil
 import tempfile
+import time
+import csv
+import sqlite3
+import io
+import html
+import zipfile
+import zlib
+import pickle
+from array import array
 from datetime import datetime
 import concurrent.futures
+import multiprocessing
+import multiprocessing.connection
 from functools import partial
+from itertools import zip_longest
 import fnmatch
+from collections import deque, Counter
+from xml.sax.saxutils import escape
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import resource
+except ImportError:
+    resource = None
 
 from PyQt6.QtWidgets import (QApplication, QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QLineEdit,
                              QLabel, QFileDialog, QTextEdit, QListWidget, QMessageBox, QStyle, QStyleFactory,
                              QProgressBar, QTableWidget, QTableWidgetItem, QHeaderView, QDialogButtonBox,
                              QMainWindow, QToolBar, QAbstractItemView, QMenu, QDialog, QComboBox, QTextBrowser,
-                             QSplitter, QSpinBox, QFrame, QSizePolicy)
+                             QSplitter, QSpinBox, QFrame, QSizePolicy, QCheckBox)
 from PyQt6.QtCore import Qt, QThread, pyqtSignal, QSize, QMimeData, QTimer, QPropertyAnimation
 from PyQt6.QtGui import QIcon, QFont, QPalette, QColor, QDragEnterEvent, QDropEvent, QAction
 
 from docx import Document
+from docx.oxml import OxmlElement
+from docx.oxml.ns import qn
 import openpyxl
 import markdown
 
-class ReplacementWorker(QThread):
-    progress = pyqtSignal(int)
-    file_processed = pyqtSignal(str, bool, int)
-    finished = pyqtSignal(dict)
+# 应用数据目录，用于保存编译后的规则集等持久化缓存
+APP_DATA_DIR = os.path.join(os.path.expanduser("~"), ".word_replacer")
+RULE_SET_DIR = os.path.join(APP_DATA_DIR, "rulesets")
+CORPUS_INDEX_PATH = os.path.join(APP_DATA_DIR, "corpus_index.sqlite")
+QUARANTINE_PATH = os.path.join(APP_DATA_DIR, "quarantine.json")
+CONCURRENCY_PATH = os.path.join(APP_DATA_DIR, "concurrency.json")
+JOURNAL_PATH = os.path.join(APP_DATA_DIR, "journal.sqlite")
+# 逐行差异超过该大小时改为保存压缩后的完整文件
+JOURNAL_DELTA_LIMIT = 64 * 1024 * 1024
+# 自动调整并发时，少于该文件数不做测量；最多用前 30% 的文件做测量
+AUTOTUNE_MIN_FILES = 20
+AUTOTUNE_FRACTION = 0.3
+# 扫描预览时每条规则在每个文件中保留的上下文示例数和上下文长度
+SNIPPETS_PER_RULE = 3
+SNIPPET_CONTEXT = 15
+# 预览区最多显示的字符数（命中次数仍按全文统计），以及缓存提取文本的文件数
+PREVIEW_CHAR_LIMIT = 50000
+PREVIEW_CACHE_SIZE = 32
+PREVIEW_COLORS = ["#ffe082", "#a5d6a7", "#90caf9", "#f48fb1", "#ce93d8", "#ffcc80", "#80deea", "#e6ee9c"]
+# Linux 上克隆文件数据块的 ioctl (FICLONE)，Btrfs、XFS 等文件系统支持
+FICLONE = 0x40049409
+# 模板批量生成时数据表中用于指定输出文件名的列
+FANOUT_FILENAME_COLUMN = "输出文件名"
+CSV_EXTENSIONS = ['.csv', '.tsv']
+SUPPORTED_EXTENSIONS = ('.docx', '.xlsx', '.txt', '.md', '.csv', '.tsv')
+# 导出的数据表中可能有很长的单元格
+csv.field_size_limit(min(sys.maxsize, 2 ** 31 - 1))
+
+# 规则集文件格式：文件头 + 偏移数组 + 前缀树数组 + UTF-8 字符串区 + 冲突信息(JSON)
+RULE_SET_MAGIC = b'WRRS'
+RULE_SET_VERSION = 2
+RULE_SET_HEADER = struct.Struct('<4sI32sIII')
+# 前缀树节点上没有规则结束时的标记
+NO_RULE = 0xFFFFFFFF
+# 缓存目录中最多保留的编译结果数，超出时删除最久未使用的
+RULE_SET_CACHE_SIZE = 20
+# 规则数不超过该值时直接逐条判断是否出现，不再使用前缀树
+SMALL_RULE_SET = 256
+
+
+def normalize_rules(pairs):
+    # 去除首尾空白，丢弃无效规则；重复的原文本以最后一次为准，保留首次出现的位置
+    merged = {}
+    duplicates = set()
+    for old_text, new_text in pairs:
+        old_text = str(old_text).strip()
+        new_text = str(new_text).strip()
+        if not old_text or not new_text or old_text == new_text:
+            continue
+        if old_text in merged and merged[old_text] != new_text:
+            duplicates.add(old_text)
+        merged[old_text] = new_text
+    return list(merged.items()), duplicates
+
+
+def rule_set_fingerprint(pairs):
+    # 按规范化后的规则计算，只是空白或重复项不同的规则列表共用同一个编译结果
+    rules, duplicates = normalize_rules(pairs)
+    payload = json.dumps([RULE_SET_VERSION, rules, sorted(duplicates)], ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).digest()
+
+
+class RuleMatcher:
+    # 针对一组候选规则的匹配器：单次扫描，最左最长匹配
+    def __init__(self, rule_set, rule_ids):
+        self.rule_set = rule_set
+        self.lookup = {rule_set.old_text(rule_id): rule_id for rule_id in rule_ids}
+        if self.lookup:
+            alternatives = sorted(self.lookup, key=len, reverse=True)
+            self.pattern = re.compile('|'.join(map(re.escape, alternatives)))
+        else:
+            self.pattern = None
 
-    def __init__(self, files, rules, backup_dir, max_workers=None):
-        super().__init__()
-        self.files = files
-        self.rules = rules
-        self.backup_dir = backup_dir
-        self.max_workers = max_workers or os.cpu_count()
+    def finditer(self, text):
+        if self.pattern is None:
+            return
+        for match in self.pattern.finditer(text):
+            yield match.start(), match.end(), self.lookup[match.group()]
+
+    def apply(self, text):
+        counts = {}
+        if self.pattern is None:
+            return text, counts
+
+        def substitute(match):
+            rule_id = self.lookup[match.group()]
+            counts[rule_id] = counts.get(rule_id, 0) + 1
+            return self.rule_set.new_text(rule_id)
+
+        return self.pattern.sub(substitute, text), counts
+
+
+class IndexedRuleMatcher(RuleMatcher):
+    # 大规则集使用前缀树逐位置匹配，避免构造超大的正则表达式
+    def __init__(self, rule_set):
+        self.rule_set = rule_set
+
+    def finditer(self, text):
+        rule_set = self.rule_set
+        i = 0
+        while i < len(text):
+            rule_id = rule_set.longest_at(text, i)
+            if rule_id is None:
+                i += 1
+                continue
+            end = i + len(rule_set.old_text(rule_id))
+            yield i, end, rule_id
+            i = end
+
+    def apply(self, text):
+        counts = {}
+        pieces = []
+        last = 0
+        for start, end, rule_id in self.finditer(text):
+            pieces.append(text[last:start])
+            pieces.append(self.rule_set.new_text(rule_id))
+            counts[rule_id] = counts.get(rule_id, 0) + 1
+            last = end
+        if not counts:
+            return text, counts
+        pieces.append(text[last:])
+        return ''.join(pieces), counts
+
+
+class RuleSet:
+    # 规范化后的规则集，包含冲突分析和按原文本建立的前缀树，可保存为内存映射文件
+    def __init__(self, strings, trie, conflicts, path=None, blob=None):
+        self.path = path
+        self.conflicts = conflicts
+        self._strings = strings
+        self._blob = blob
+        self._decoded = {}
+        # 节点 k 的出边为 edge_offsets[k] 到 edge_offsets[k + 1]，按字符编码升序排列；
+        # node_rules[k] 为在该节点结束的规则编号
+        self._edge_offsets, self._edge_chars, self._edge_targets, self._node_rules = trie
+        # 走到过的节点的出边解码为字典缓存起来，加载时不必解码整棵树
+        self._children = {}
+        self._roots = self._edges(0)
+        self._matchers = {}
+        self._indexed_matcher = IndexedRuleMatcher(self)
+
+    @classmethod
+    def from_pairs(cls, pairs, analyze=True):
+        # analyze=False 时跳过冲突分析，只建立匹配所需的前缀树
+        rules, duplicates = normalize_rules(pairs)
+        strings = []
+        children = [{}]
+        node_rules = array('I', [NO_RULE])
+        for rule_id, (old_text, new_text) in enumerate(rules):
+            strings.extend((old_text, new_text))
+            node = 0
+            for char in old_text:
+                child = children[node].get(char)
+                if child is None:
+                    child = len(children)
+                    children[node][char] = child
+                    children.append({})
+                    node_rules.append(NO_RULE)
+                node = child
+            node_rules[node] = rule_id
+
+        edge_offsets = array('I', [0])
+        edge_chars = array('I')
+        edge_targets = array('I')
+        for edges in children:
+            for char in sorted(edges):
+                edge_chars.append(ord(char))
+                edge_targets.append(edges[char])
+            edge_offsets.append(len(edge_chars))
+
+        rule_set = cls(strings, (edge_offsets, edge_chars, edge_targets, node_rules), [])
+        if analyze:
+            rule_set.conflicts = rule_set.analyze_conflicts(duplicates)
+        return rule_set
+
+    @classmethod
+    def load(cls, path, fingerprint=None):
+        with open(path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(mapped)
+        if len(view) < RULE_SET_HEADER.size:
+            raise ValueError("规则集文件已损坏")
+        magic, version, stored_fingerprint, rule_count, node_count, conflicts_size = RULE_SET_HEADER.unpack_from(view)
+        if magic != RULE_SET_MAGIC or version != RULE_SET_VERSION:
+            raise ValueError("规则集文件版本不匹配")
+        if fingerprint is not None and stored_fingerprint != fingerprint:
+            raise ValueError("规则集指纹不匹配")
+
+        offset = RULE_SET_HEADER.size
+
+        def take(size):
+            nonlocal offset
+            if offset + size > len(view):
+                raise ValueError("规则集文件已损坏")
+            part = view[offset:offset + size]
+            offset += size
+            return part
+
+        rule_offsets = take(4 * (2 * rule_count + 1)).cast('I')
+        edge_offsets = take(4 * (node_count + 1)).cast('I')
+        node_rules = take(4 * node_count).cast('I')
+        edge_chars = take(4 * edge_offsets[-1]).cast('I')
+        edge_targets = take(4 * edge_offsets[-1]).cast('I')
+        rule_blob = take(rule_offsets[-1])
+        conflicts = json.loads(str(take(conflicts_size), 'utf-8'))
+
+        # 前缀树直接使用映射区中的数组，规则文本在用到时才从映射区解码
+        trie = (edge_offsets, edge_chars, edge_targets, node_rules)
+        return cls(None, trie, conflicts, path=path, blob=(rule_offsets, rule_blob))
+
+    def save(self, path, fingerprint):
+        rule_offsets = array('I', [0])
+        rule_blob = bytearray()
+        for k in range(2 * len(self)):
+            rule_blob += self._string(k).encode('utf-8')
+            rule_offsets.append(len(rule_blob))
+
+        conflicts = json.dumps(self.conflicts, ensure_ascii=False).encode('utf-8')
+        header = RULE_SET_HEADER.pack(RULE_SET_MAGIC, RULE_SET_VERSION, fingerprint,
+                                      len(self), len(self._node_rules), len(conflicts))
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(header)
+            f.write(rule_offsets.tobytes())
+            f.write(array('I', self._edge_offsets).tobytes())
+            f.write(array('I', self._node_rules).tobytes())
+            f.write(array('I', self._edge_chars).tobytes())
+            f.write(array('I', self._edge_targets).tobytes())
+            f.write(rule_blob)
+            f.write(conflicts)
+        os.replace(temp_path, path)
+
+    def __reduce__(self):
+        # 进程间传递时只传路径，子进程重新映射同一个文件
+        if self.path:
+            return load_shared_rule_set, (self.path,)
+        return RuleSet.from_pairs, (list(self),)
+
+    def __len__(self):
+        if self._strings is not None:
+            return len(self._strings) // 2
+        return (len(self._blob[0]) - 1) // 2
+
+    def __iter__(self):
+        for rule_id in range(len(self)):
+            yield self.old_text(rule_id), self.new_text(rule_id)
+
+    def _string(self, k):
+        if self._strings is not None:
+            return self._strings[k]
+        text = self._decoded.get(k)
+        if text is None:
+            offsets, blob = self._blob
+            text = str(blob[offsets[k]:offsets[k + 1]], 'utf-8')
+            self._decoded[k] = text
+        return text
+
+    def old_text(self, rule_id):
+        return self._string(2 * rule_id)
+
+    def new_text(self, rule_id):
+        return self._string(2 * rule_id + 1)
+
+    def _edges(self, node):
+        edges = self._children.get(node)
+        if edges is None:
+            edges = {chr(self._edge_chars[k]): self._edge_targets[k]
+                     for k in range(self._edge_offsets[node], self._edge_offsets[node + 1])}
+            self._children[node] = edges
+        return edges
+
+    def _rules_at(self, text, i):
+        # 沿前缀树返回从位置 i 开始能匹配的规则，由短到长
+        found = []
+        node = self._roots.get(text[i])
+        children = self._children
+        node_rules = self._node_rules
+        j = i + 1
+        while node is not None:
+            rule_id = node_rules[node]
+            if rule_id != NO_RULE:
+                found.append(rule_id)
+            if j == len(text):
+                break
+            edges = children.get(node)
+            if edges is None:
+                edges = self._edges(node)
+            node = edges.get(text[j])
+            j += 1
+        return found
+
+    def longest_at(self, text, i):
+        # 返回从位置 i 开始能匹配的最长规则；大多数位置在根节点就没有出边，直接返回
+        if text[i] not in self._roots:
+            return None
+        found = self._rules_at(text, i)
+        return found[-1] if found else None
+
+    def candidates(self, text, timings=None):
+        # 返回在文本中出现的规则编号（包括相互重叠的出现）；timings 用于累计每条规则的扫描耗时
+        if len(self) <= SMALL_RULE_SET:
+            if timings is None:
+                return [rule_id for rule_id in range(len(self)) if self.old_text(rule_id) in text]
+            found = []
+            for rule_id in range(len(self)):
+                started = time.perf_counter()
+                present = self.old_text(rule_id) in text
+                timings[rule_id] = timings.get(rule_id, 0.0) + time.perf_counter() - started
+                if present:
+                    found.append(rule_id)
+            return found
+
+        found = set()
+        for i in range(len(text)):
+            if text[i] in self._roots:
+                found.update(self._rules_at(text, i))
+        return sorted(found)
+
+    def matcher(self, text=None, timings=None):
+        if len(self) > SMALL_RULE_SET:
+            return self._indexed_matcher
+        rule_ids = tuple(range(len(self)) if text is None else self.candidates(text, timings))
+        matcher = self._matchers.get(rule_ids)
+        if matcher is None:
+            if len(self._matchers) > 128:
+                self._matchers.clear()
+            matcher = RuleMatcher(self, rule_ids)
+            self._matchers[rule_ids] = matcher
+        return matcher
+
+    def apply(self, text):
+        return self.matcher(text).apply(text)
+
+    def analyze_conflicts(self, duplicates=()):
+        conflicts = []
+        for rule_id in range(len(self)):
+            old_text = self.old_text(rule_id)
+            if old_text in duplicates:
+                conflicts.append(['duplicate', rule_id, -1])
+            # 其他规则的原文本包含在本规则原文本中：重叠处优先匹配较长的文本
+            for other_id in self.candidates(old_text):
+                if other_id != rule_id:
+                    conflicts.append(['overlap', rule_id, other_id])
+            # 替换结果中包含其他规则的原文本：替换结果不会被再次替换
+            for other_id in self.candidates(self.new_text(rule_id)):
+                if other_id != rule_id:
+                    conflicts.append(['chain', rule_id, other_id])
+        return conflicts
+
+    def describe_conflict(self, conflict):
+        kind, rule_id, other_id = conflict
+        if kind == 'duplicate':
+            return f'规则 "{self.old_text(rule_id)}" 重复定义，使用最后一次的替换文本 "{self.new_text(rule_id)}"'
+        if kind == 'overlap':
+            return f'规则 "{self.old_text(rule_id)}" 包含规则 "{self.old_text(other_id)}"，重叠处优先匹配较长的文本'
+        return f'规则 "{self.old_text(rule_id)}" 的替换结果包含 "{self.old_text(other_id)}"，不会被再次替换'
+
+
+# 每个进程内已映射的规则集，按文件路径共享
+_shared_rule_sets = {}
+# 预览使用的规则集只在内存中保留最近几个，不写入缓存目录
+_preview_rule_sets = {}
+
+
+def load_shared_rule_set(path):
+    rule_set = _shared_rule_sets.get(path)
+    if rule_set is None:
+        rule_set = RuleSet.load(path)
+        _shared_rule_sets[path] = rule_set
+    return rule_set
+
+
+def load_rule_set(pairs, cache_dir=RULE_SET_DIR):
+    # 按内容指纹查找编译后的规则集，不存在或已损坏时重新编译
+    fingerprint = rule_set_fingerprint(pairs)
+    path = os.path.join(cache_dir, fingerprint.hex() + '.wrc')
+    rule_set = _shared_rule_sets.get(path)
+    if rule_set is not None:
+        return rule_set
+    try:
+        rule_set = RuleSet.load(path, fingerprint)
+        # 修改时间记录最近一次使用，清理缓存时据此保留最近用过的规则集
+        os.utime(path)
+    except (OSError, ValueError):
+        rule_set = RuleSet.from_pairs(pairs)
+        try:
+            rule_set.save(path, fingerprint)
+            rule_set = RuleSet.load(path, fingerprint)
+        except (OSError, ValueError):
+            return rule_set
+        prune_rule_sets(cache_dir)
+    _shared_rule_sets[path] = rule_set
+    return rule_set
+
+
+def prune_rule_sets(cache_dir, keep=RULE_SET_CACHE_SIZE):
+    # 只保留最近使用的若干个编译结果；当前进程已映射的文件不删除
+    try:
+        entries = [entry for entry in os.scandir(cache_dir) if entry.name.endswith('.wrc')]
+    except OSError:
+        return
+    entries.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+    for entry in entries[keep:]:
+        if entry.path in _shared_rule_sets:
+            continue
+        try:
+            os.remove(entry.path)
+        except OSError:
+            pass
+
+
+def document_paragraphs(doc):
+    # 替换、扫描和提取文本共用的遍历顺序：正文段落，然后是表格中的段落
+    yield from doc.paragraphs
+    # 合并单元格会在 row.cells 中重复出现，每个单元格只处理一次
+    seen_cells = set()
+    for table in doc.tables:
+        for row in table.rows:
+            for cell in row.cells:
+                if cell._tc in seen_cells:
+                    continue
+                seen_cells.add(cell._tc)
+                yield from cell.paragraphs
+
+
+def document_text(doc):
+    return '\n'.join(para.text for para in document_paragraphs(doc))
+
+
+def paragraph_pieces(p):
+    # 段落中各 run 的文本节点及制表符、换行等元素：[元素, 起点, 终点, 文本]，拼接后与 para.text 相同
+    pieces = []
+    start = 0
+    for run in p.xpath("w:r | w:hyperlink/w:r"):
+        for element in run.xpath("w:br | w:cr | w:noBreakHyphen | w:ptab | w:t | w:tab"):
+            text = str(element)
+            pieces.append([element, start, start + len(text), text])
+            start += len(text)
+    return pieces
+
+
+def edit_paragraph(pieces, matches, replacement):
+    # 把匹配 (起点, 终点, 键) 映射到各个文本节点上，只修改涉及到的 w:t；
+    # replacement(键) 的结果写入匹配的第一个文本节点，其余节点中被匹配的部分删除
+
+    # 每个片段上的修改：(片段内起点, 片段内终点, 插入的文本)
+    edits = {}
+    index = 0
+    for match_start, match_end, key in matches:
+        while pieces[index][2] <= match_start:
+            index += 1
+        affected = []
+        i = index
+        while i < len(pieces) and pieces[i][1] < match_end:
+            if pieces[i][2] > pieces[i][1]:
+                affected.append(i)
+            i += 1
+        target = next((i for i in affected if pieces[i][0].tag == qn('w:t')), None)
+        if target is None:
+            # 匹配只落在制表符、换行等元素上时，在其前面插入新的文本节点
+            element = OxmlElement('w:t')
+            pieces[affected[0]][0].addprevious(element)
+            pieces.insert(affected[0], [element, match_start, match_start, ''])
+            affected = [affected[0]] + [i + 1 for i in affected]
+            target = affected[0]
+        for i in affected:
+            element, piece_start, piece_end, text = pieces[i]
+            cut = (max(match_start, piece_start) - piece_start, min(match_end, piece_end) - piece_start,
+                   replacement(key) if i == target else '')
+            edits.setdefault(i, []).append(cut)
+
+    for i, cuts in edits.items():
+        element, _, _, text = pieces[i]
+        if element.tag != qn('w:t'):
+            element.getparent().remove(element)
+            continue
+        for cut_start, cut_end, inserted in reversed(cuts):
+            text = text[:cut_start] + inserted + text[cut_end:]
+        element.text = text
+        element.set(qn('xml:space'), 'preserve')
+    return len(matches)
+
+
+def csv_dialect(sample, default=csv.excel):
+    # 只采用识别出的分隔符；引号始终按 RFC 4180 处理。样本中没有 "" 时 Sniffer 会误判为不使用双引号转义，
+    # 之后遇到 "" 或字段中的单个引号就无法写出
+    try:
+        delimiter = csv.Sniffer().sniff(sample, delimiters=',\t;|').delimiter
+    except csv.Error:
+        return default
+    return type('SniffedDialect', (csv.excel,), {'delimiter': delimiter})
+
+
+class RawLines:
+    # 包装文件的行迭代器，记录 csv.reader 读取每条记录时消耗的原始行，未修改的记录可原样写回
+    def __init__(self, file):
+        self.file = file
+        self.lines = []
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = next(self.file)
+        self.lines.append(line)
+        return line
+
+    def take(self):
+        raw = ''.join(self.lines)
+        self.lines = []
+        return raw
+
+
+def open_csv(file, file_path='', lines=None):
+    # 按文件开头的样本识别分隔符和换行符，返回 (reader, 方言, 换行符)；lines 为 RawLines 时从中读取
+    sample = file.read(64 * 1024)
+    file.seek(0)
+    default = csv.excel_tab if file_path.lower().endswith('.tsv') else csv.excel
+    newline = sample.find('\n')
+    lineterminator = '\r\n' if newline > 0 and sample[newline - 1] == '\r' else '\n'
+    dialect = csv_dialect(sample, default)
+    return csv.reader(file if lines is None else lines, dialect), dialect, lineterminator
+
+
+def has_utf8_bom(file_path):
+    with open(file_path, 'rb') as f:
+        return f.read(3) == b'\xef\xbb\xbf'
+
+
+def extract_text(file_path):
+    # 提取与替换时相同范围的文本：Word 段落和表格、Excel 字符串单元格、纯文本内容
+    file_extension = os.path.splitext(file_path)[1].lower()
+    if file_extension == '.docx':
+        return document_text(Document(file_path))
+    elif file_extension == '.xlsx':
+        wb = openpyxl.load_workbook(file_path, read_only=True)
+        texts = []
+        for sheet in wb.worksheets:
+            for row in sheet.iter_rows(values_only=True):
+                texts.extend(value for value in row if isinstance(value, str))
+        wb.close()
+        return '\n'.join(texts)
+    elif file_extension in ['.txt', '.md'] + CSV_EXTENSIONS:
+        with open(file_path, 'r', encoding='utf-8-sig') as file:
+            return file.read()
+    else:
+        raise ValueError(f"Unsupported file type: {file_extension}")
+
+
+class CorpusIndex:
+    # 已加载文件的文本缓存和全文索引，按 (路径, 修改时间, 大小) 增量更新
+    def __init__(self, path=CORPUS_INDEX_PATH):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self.connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS files ("
+                         "id INTEGER PRIMARY KEY, path TEXT UNIQUE, mtime REAL, size INTEGER, content TEXT)")
+            try:
+                # trigram 分词对中文等不以空格分词的文字同样有效
+                conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS file_text USING fts5("
+                             "content, content='files', content_rowid='id', tokenize='trigram case_sensitive 1')")
+                self.fts = True
+            except sqlite3.OperationalError:
+                self.fts = False
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def update(self, paths, max_workers=None):
+        # 只重新提取新增或已修改的文件，返回本次提取的文件数
+        stale = self.stale_files(paths)
+        if not stale:
+            return 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            contents = executor.map(self.try_extract, [path for path, _, _ in stale])
+            self.store(zip(stale, contents))
+        return len(stale)
+
+    def stale_files(self, paths):
+        # 返回需要重新提取的 (路径, 修改时间, 大小)
+        with self.connect() as conn:
+            indexed = {path: (file_id, mtime, size) for file_id, path, mtime, size
+                       in conn.execute("SELECT id, path, mtime, size FROM files")}
+
+        stale = []
+        for path in paths:
+            if os.path.splitext(path)[1].lower() in CSV_EXTENSIONS:
+                # 数据表可能有数 GB，不放入索引，每次都流式扫描
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entry = indexed.get(path)
+            if entry is None or entry[1] != stat.st_mtime or entry[2] != stat.st_size:
+                stale.append((path, stat.st_mtime, stat.st_size))
+        return stale
+
+    def store(self, entries):
+        # entries 为 ((路径, 修改时间, 大小), 文本) 序列；文本为 None 表示提取失败，不放入索引
+        with self.connect() as conn:
+            for (path, mtime, size), content in entries:
+                self.remove(conn, path)
+                if content is None:
+                    continue
+                cursor = conn.execute("INSERT INTO files (path, mtime, size, content) VALUES (?, ?, ?, ?)",
+                                      (path, mtime, size, content))
+                if self.fts:
+                    conn.execute("INSERT INTO file_text (rowid, content) VALUES (?, ?)",
+                                 (cursor.lastrowid, content))
+
+    def cached_text(self, path):
+        # 文件自建立索引后未修改时直接返回已提取的文本
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        with self.connect() as conn:
+            row = conn.execute("SELECT mtime, size, content FROM files WHERE path = ?", (path,)).fetchone()
+        if row is None or row[0] != stat.st_mtime or row[1] != stat.st_size:
+            return None
+        return row[2]
+
+    def try_extract(self, path):
+        try:
+            return extract_text(path)
+        except Exception:
+            return None
 
-    def run(self):
-        total_files = len(self.files)
-        stats = {
-            "total_files": total_files,
-            "changed_files": 0,
-            "total_replacements": 0
-        }
+    def remove(self, conn, path):
+        row = conn.execute("SELECT id, content FROM files WHERE path = ?", (path,)).fetchone()
+        if row is None:
+            return
+        if self.fts:
+            conn.execute("INSERT INTO file_text (file_text, rowid, content) VALUES ('delete', ?, ?)", row)
+        conn.execute("DELETE FROM files WHERE id = ?", (row[0],))
+
+    def files_containing(self, conn, term):
+        if self.fts and len(term) >= 3:
+            phrase = '"' + term.replace('"', '""') + '"'
+            rows = conn.execute("SELECT rowid FROM file_text WHERE file_text MATCH ?", (phrase,))
+        else:
+            rows = conn.execute("SELECT id FROM files WHERE instr(content, ?) > 0", (term,))
+        return {file_id for file_id, in rows}
+
+    def candidate_files(self, rule_set, paths):
+        # 返回可能包含任意规则原文本的文件；未能建立索引的文件一律保留
+        with self.connect() as conn:
+            ids = {}
+            for path in paths:
+                row = conn.execute("SELECT id FROM files WHERE path = ?", (path,)).fetchone()
+                ids[path] = row[0] if row else None
+
+            if len(rule_set) <= SMALL_RULE_SET:
+                matched = set()
+                for old_text, _ in rule_set:
+                    matched |= self.files_containing(conn, old_text)
+            else:
+                # 规则很多时逐条查询反而更慢，直接用规则集扫描缓存的文本
+                matched = set()
+                for file_id in ids.values():
+                    if file_id is None:
+                        continue
+                    content, = conn.execute("SELECT content FROM files WHERE id = ?", (file_id,)).fetchone()
+                    if next(rule_set.matcher(content).finditer(content), None) is not None:
+                        matched.add(file_id)
+
+        return [path for path in paths if ids[path] is None or ids[path] in matched]
+
+
+class ConcurrencyTuner:
+    # 在任务开始阶段按窗口测量吞吐量，用爬山法调整并发数，调好后固定不变
+    def __init__(self, initial, maximum, tune_items=0):
+        self.maximum = max(1, maximum)
+        self.level = max(1, min(initial, self.maximum))
+        self.initial = self.level
+        self.budget = tune_items
+        self.tuning = tune_items > 0
+        self.best_level = None
+        self.best_rate = 0.0
+        self.direction = 1 if self.level < self.maximum else -1
+        self.start_window()
+
+    def start_window(self):
+        self.window_started = time.monotonic()
+        self.window_items = 0
+        self.window_units = 0
+        self.window_size = max(4, 2 * self.level)
+
+    def completed(self, units=1):
+        # units 为本次完成的工作量：CPU 阶段按文件数，I/O 阶段按字节数
+        if not self.tuning:
+            return
+        self.budget -= 1
+        self.window_items += 1
+        self.window_units += units
+        if self.window_items < self.window_size and self.budget > 0:
+            return
 
-        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-            future_to_file = {executor.submit(self.process_file, file_path): file_path for file_path in self.files}
-            for i, future in enumerate(concurrent.futures.as_completed(future_to_file)):
-                file_path = future_to_file[future]
+        rate = self.window_units / max(time.monotonic() - self.window_started, 1e-6)
+        level = self.level
+        if self.best_level is None or rate > self.best_rate * 1.05:
+            self.best_level, self.best_rate = level, rate
+            step = max(1, level // 2) if self.direction > 0 else 1
+            next_level = level + self.direction * step
+        elif self.direction > 0 and self.best_level == self.initial and self.initial > 1:
+            # 增加并发没有带来提升，改为尝试减少
+            self.direction = -1
+            next_level = self.initial - 1
+        else:
+            next_level = None
+
+        if next_level is None or not 1 <= next_level <= self.maximum or self.budget <= 0:
+            self.finish()
+        else:
+            self.level = next_level
+            self.start_window()
+
+    def finish(self):
+        if self.best_level is not None:
+            self.level = self.best_level
+        self.tuning = False
+
+    @property
+    def measured(self):
+        # 至少测量过一个窗口；该阶段的任务太少时并发数仍是初始值，不应当作测量结果保存
+        return self.best_level is not None
+
+
+def storage_root(path):
+    # 文件所在的挂载点（Windows 上为盘符或网络共享根目录），用于区分本地磁盘和 NAS
+    path = os.path.abspath(path)
+    while not os.path.ismount(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return path
+
+
+def workload_key(files):
+    roots = Counter(storage_root(os.path.dirname(file_path)) for file_path in files)
+    extensions = Counter(os.path.splitext(file_path)[1].lower() for file_path in files)
+    # 只记录占比不低于 10% 的文件类型，避免个别文件改变分组
+    mix = '+'.join(sorted(ext.lstrip('.') for ext, count in extensions.items() if count * 10 >= len(files)))
+    return f"{roots.most_common(1)[0][0]}|{mix}"
+
+
+def load_concurrency():
+    try:
+        with open(CONCURRENCY_PATH, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_concurrency(key, levels):
+    # levels 只包含实际测量过的阶段，未测量的阶段保留之前保存的值
+    settings = load_concurrency()
+    settings.setdefault(key, {}).update(levels)
+    os.makedirs(os.path.dirname(CONCURRENCY_PATH), exist_ok=True)
+    temp_path = f"{CONCURRENCY_PATH}.{os.getpid()}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(settings, f, ensure_ascii=False, indent=2)
+    os.replace(temp_path, CONCURRENCY_PATH)
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(partial(f.read, chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def group_duplicates(paths, tuner):
+    # 先按大小分组，只对大小相同的文件计算哈希；返回内容相同的文件组，组内第一个为代表
+    by_size = {}
+    for path in paths:
+        try:
+            by_size.setdefault(os.path.getsize(path), []).append(path)
+        except OSError:
+            by_size.setdefault(None, []).append(path)
+
+    to_hash = deque((path, size) for size, group in by_size.items() if size is not None and len(group) > 1
+                    for path in group)
+    digests = {}
+    in_flight = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=tuner.maximum) as executor:
+        while to_hash or in_flight:
+            while to_hash and len(in_flight) < tuner.level:
+                path, size = to_hash.popleft()
+                in_flight[executor.submit(file_digest, path)] = (path, size)
+            done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                path, size = in_flight.pop(future)
                 try:
-                    changed, file_replacements = future.result()
-                    if changed:
-                        stats["changed_files"] += 1
-                        stats["total_replacements"] += file_replacements
-                        self.file_processed.emit(file_path, True, file_replacements)
-                    else:
-                        self.file_processed.emit(file_path, False, 0)
-                except Exception as e:
-                    self.file_processed.emit(file_path, False, 0)
-                self.progress.emit(int((i + 1) / total_files * 100))
+                    digests[path] = future.result()
+                except OSError:
+                    pass
+                tuner.completed(size)
 
-        self.finished.emit(stats)
+    groups = {}
+    for path in paths:
+        key = digests.get(path, path)
+        groups.setdefault(key, []).append(path)
+    return list(groups.values())
 
+
+def clone_file(src, dst):
+    # 优先使用写时复制的克隆，不支持时退回普通复制；保留目标文件自身的权限等元数据
+    if fcntl is not None:
+        try:
+            with open(src, 'rb') as source, os.fdopen(os.open(dst, os.O_WRONLY | os.O_CREAT, 0o666), 'wb') as target:
+                fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+                target.truncate(os.fstat(source.fileno()).st_size)
+            return
+        except OSError:
+            pass
+    shutil.copyfile(src, dst)
+
+
+def link_or_copy(src, dst):
+    # 输出目录模式下未更改的文件优先创建硬链接，跨设备等不支持时复制
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+class MatchTally:
+    # 记录单个文件替换过程中每条规则的命中次数和耗时
+    def __init__(self, rule_set, text):
+        self.counts = {}
+        self.snippets = {}
+        self.scan_seconds = {}
+        # 大规则集在前缀树上同时查找所有规则，无法逐条计时，扫描耗时由全部规则分担
+        self.shared_rules = len(rule_set) if len(rule_set) > SMALL_RULE_SET else 0
+        started = time.perf_counter()
+        self.matcher = rule_set.matcher(text, self.scan_seconds)
+        self.match_seconds = time.perf_counter() - started
+
+    def apply(self, text):
+        started = time.perf_counter()
+        new_text, counts = self.matcher.apply(text)
+        self.match_seconds += time.perf_counter() - started
+        for rule_id, count in counts.items():
+            self.counts[rule_id] = self.counts.get(rule_id, 0) + count
+        return new_text, sum(counts.values())
+
+    def matches(self, text):
+        # 返回所有匹配的 (起点, 终点, 规则编号)，由调用方自行修改文本
+        started = time.perf_counter()
+        found = list(self.matcher.finditer(text))
+        self.match_seconds += time.perf_counter() - started
+        for _, _, rule_id in found:
+            self.counts[rule_id] = self.counts.get(rule_id, 0) + 1
+        return found
+
+    def scan(self, text):
+        # 只统计匹配并截取上下文，不生成替换后的文本
+        started = time.perf_counter()
+        for start, end, rule_id in self.matcher.finditer(text):
+            self.counts[rule_id] = self.counts.get(rule_id, 0) + 1
+            snippets = self.snippets.setdefault(rule_id, [])
+            if len(snippets) < SNIPPETS_PER_RULE:
+                before = text[max(start - SNIPPET_CONTEXT, 0):start]
+                after = text[end:end + SNIPPET_CONTEXT]
+                snippets.append(f"{before}【{text[start:end]}】{after}".replace('\n', ' '))
+        self.match_seconds += time.perf_counter() - started
+
+    def matrix_row(self):
+        return [[rule_id, count, self.snippets.get(rule_id, [])] for rule_id, count in sorted(self.counts.items())]
+
+    @property
+    def total(self):
+        return sum(self.counts.values())
+
+    def __getstate__(self):
+        # 从子进程传回结果时不需要匹配器
+        state = self.__dict__.copy()
+        state.pop('matcher', None)
+        return state
+
+    def remaining_seconds(self):
+        # 未能逐条计入规则的匹配耗时
+        return max(self.match_seconds - sum(self.scan_seconds.values()), 0.0)
+
+    def rule_seconds(self):
+        # 逐条扫描的耗时直接计入对应规则，其余的匹配耗时按命中次数分摊；
+        # 分担扫描耗时时每条规则另占一份，这部分见 shared_seconds
+        seconds = dict(self.scan_seconds)
+        remaining = self.remaining_seconds()
+        shares = self.total + self.shared_rules
+        for rule_id, count in self.counts.items():
+            seconds[rule_id] = seconds.get(rule_id, 0.0) + remaining * count / shares
+        return seconds
+
+    def shared_seconds(self):
+        # 每条规则（包括未命中的规则）分担的扫描耗时
+        if not self.shared_rules:
+            return 0.0
+        return self.remaining_seconds() / (self.total + self.shared_rules)
+
+
+def backup_path(backup_dir, file_path):
+    # 备份文件名带上完整路径的哈希，不同文件夹下的同名文件不会互相覆盖
+    digest = hashlib.sha1(os.path.abspath(file_path).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(backup_dir, f"{digest}_{os.path.basename(file_path)}")
+
+
+def load_quarantine():
+    try:
+        with open(QUARANTINE_PATH, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_quarantine(quarantine):
+    os.makedirs(os.path.dirname(QUARANTINE_PATH), exist_ok=True)
+    temp_path = f"{QUARANTINE_PATH}.{os.getpid()}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(quarantine, f, ensure_ascii=False, indent=2)
+    os.replace(temp_path, QUARANTINE_PATH)
+
+
+def quarantine_reason(quarantine, file_path):
+    # 被隔离的文件在修改之前一直跳过；文件变化后自动解除隔离
+    entry = quarantine.get(file_path)
+    if entry is None:
+        return None
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    if entry["mtime"] == stat.st_mtime and entry["size"] == stat.st_size:
+        return entry["reason"]
+    del quarantine[file_path]
+    return None
+
+
+def quarantine_file(quarantine, file_path, reason):
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return
+    quarantine[file_path] = {"mtime": stat.st_mtime, "size": stat.st_size, "reason": reason,
+                             "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+
+
+def limit_memory(memory_limit):
+    # 在当前用量的基础上限制子进程可再申请的地址空间；无法测量当前用量的平台不做限制
+    if resource is None or not memory_limit:
+        return
+    try:
+        with open('/proc/self/statm') as f:
+            baseline = int(f.read().split()[0]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+    limit = baseline + memory_limit
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+
+
+def isolated_worker_main(conn, processor, memory_limit):
+    limit_memory(memory_limit)
+    while True:
+        try:
+            file_path = conn.recv()
+        except EOFError:
+            break
+        if file_path is None:
+            break
+        try:
+            outcome = ('ok', processor.process_file(file_path))
+        except MemoryError:
+            outcome = ('memory', f"超出内存限制（{memory_limit // (1024 * 1024)} MB）")
+        except Exception as e:
+            outcome = ('error', str(e))
+        conn.send(outcome)
+
+
+class IsolatedPool:
+    # 每个文件交给独立子进程处理；超时、超出内存或进程崩溃时结束该进程并换一个新进程
+    def __init__(self, processor, tuner, timeout, memory_limit):
+        self.processor = processor
+        self.tuner = tuner
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.context = multiprocessing.get_context('spawn')
+
+    def start_slot(self):
+        parent_conn, child_conn = self.context.Pipe()
+        process = self.context.Process(target=isolated_worker_main,
+                                       args=(child_conn, self.processor, self.memory_limit), daemon=True)
+        process.start()
+        child_conn.close()
+        return {"process": process, "conn": parent_conn, "file_path": None, "deadline": None}
+
+    def stop_slot(self, slot, kill=False):
+        if not kill:
+            try:
+                slot["conn"].send(None)
+            except OSError:
+                kill = True
+        if kill:
+            slot["process"].kill()
+        slot["process"].join(5)
+        if slot["process"].is_alive():
+            slot["process"].kill()
+            slot["process"].join()
+        slot["conn"].close()
+
+    def crash_reason(self, slot):
+        slot["process"].join(1)
+        return f"处理进程异常退出（退出码 {slot['process'].exitcode}）"
+
+    def map_unordered(self, paths):
+        pending = deque(paths)
+        slots = [self.start_slot() for _ in range(min(self.tuner.level, len(pending)))]
+        try:
+            while slots:
+                # 按当前并发数增减子进程
+                while len(slots) < self.tuner.level and len(slots) < len(pending):
+                    slots.append(self.start_slot())
+                for slot in [slot for slot in slots if slot["file_path"] is None][:max(len(slots) - self.tuner.level, 0)]:
+                    self.stop_slot(slot)
+                    slots.remove(slot)
+                for slot in slots:
+                    if slot["file_path"] is None and pending:
+                        slot["file_path"] = pending.popleft()
+                        slot["deadline"] = time.monotonic() + self.timeout
+                        try:
+                            slot["conn"].send(slot["file_path"])
+                        except OSError:
+                            slot["deadline"] = 0
+
+                busy = [slot for slot in slots if slot["file_path"] is not None]
+                if not busy:
+                    break
+                wait_time = min(max(min(slot["deadline"] for slot in busy) - time.monotonic(), 0), 1)
+                ready = multiprocessing.connection.wait([slot["conn"] for slot in busy], timeout=wait_time)
+
+                for slot in busy:
+                    if slot["conn"] in ready:
+                        try:
+                            outcome = slot["conn"].recv()
+                        except (EOFError, OSError):
+                            outcome = ('crash', self.crash_reason(slot))
+                    elif slot["deadline"] == 0:
+                        outcome = ('crash', self.crash_reason(slot))
+                    elif time.monotonic() > slot["deadline"]:
+                        outcome = ('timeout', f"处理超时（超过 {self.timeout} 秒）")
+                    else:
+                        continue
+                    file_path = slot["file_path"]
+                    slot["file_path"] = None
+                    if outcome[0] not in ('ok', 'error'):
+                        # 出问题的子进程直接结束，需要时换一个新的继续处理后面的文件
+                        self.stop_slot(slot, kill=True)
+                        slots.remove(slot)
+                        if pending:
+                            slots.append(self.start_slot())
+                    yield file_path, outcome
+
+                if not pending:
+                    for slot in [slot for slot in slots if slot["file_path"] is None]:
+                        self.stop_slot(slot)
+                        slots.remove(slot)
+        finally:
+            for slot in slots:
+                self.stop_slot(slot, kill=slot["file_path"] is not None)
+
+
+class TextExtractor:
+    # 供 IsolatedPool 在子进程中为全文索引提取文本
     def process_file(self, file_path):
-        backup_path = os.path.join(self.backup_dir, os.path.basename(file_path))
-        shutil.copy2(file_path, backup_path)
+        return extract_text(file_path)
+
+
+def content_digest(path):
+    # Word/Excel 按各部件的名称和内容计算哈希，重新打包后的文件与原文件哈希相同；其他文件按字节计算
+    if not zipfile.is_zipfile(path):
+        return file_digest(path)
+    digest = hashlib.sha256()
+    with zipfile.ZipFile(path) as package:
+        for info in package.infolist():
+            digest.update(info.filename.encode('utf-8') + b'\0')
+            digest.update(hashlib.sha256(package.read(info)).digest())
+    return 'zip:' + digest.hexdigest()
+
+
+def line_delta(before_path, after_path):
+    # 行数不变时逐行比较，只保存不同的行；行数变化或差异过大时返回 None
+    changes = []
+    size = 0
+    with open(before_path, 'rb') as before, open(after_path, 'rb') as after:
+        for index, (old, new) in enumerate(zip_longest(before, after)):
+            if old == new:
+                continue
+            if old is None or new is None:
+                return None
+            changes.append((index, old, new))
+            size += len(old) + len(new)
+            if size > JOURNAL_DELTA_LIMIT:
+                return None
+    return ('lines', changes)
+
+
+def zip_members(package, other):
+    # 列出压缩包中的部件；与另一版本中同名部件内容相同的只记录名称
+    other_infos = {info.filename: info for info in other.infolist()}
+    members = []
+    for info in package.infolist():
+        data = package.read(info)
+        match = other_infos.get(info.filename)
+        if match is not None and match.CRC == info.CRC and match.file_size == info.file_size \
+                and other.read(match) == data:
+            data = None
+        members.append((info.filename, info.date_time, info.compress_type, info.external_attr, data))
+    return members
+
+
+def make_delta(before_path, after_path):
+    if zipfile.is_zipfile(before_path) and zipfile.is_zipfile(after_path):
+        with zipfile.ZipFile(before_path) as before, zipfile.ZipFile(after_path) as after:
+            return ('zip', zip_members(before, after), zip_members(after, before))
+    return line_delta(before_path, after_path)
+
+
+def apply_delta(delta, source_path, output_path, undo):
+    # 由当前版本还原出另一版本：撤销时得到修改前的内容，重做时得到修改后的内容
+    if delta[0] == 'zip':
+        members = delta[1] if undo else delta[2]
+        with zipfile.ZipFile(source_path) as source, zipfile.ZipFile(output_path, 'w') as package:
+            for name, date_time, compress_type, external_attr, data in members:
+                info = zipfile.ZipInfo(name, date_time)
+                info.compress_type = compress_type
+                info.external_attr = external_attr
+                package.writestr(info, source.read(name) if data is None else data)
+        return
+
+    changes = iter(delta[1])
+    change = next(changes, None)
+    with open(source_path, 'rb') as source, open(output_path, 'wb') as output:
+        for index, line in enumerate(source):
+            if change is not None and change[0] == index:
+                output.write(change[1] if undo else change[2])
+                change = next(changes, None)
+            else:
+                output.write(line)
+
+
+def compress_file(source_path, target_path, chunk_size=1024 * 1024):
+    compressor = zlib.compressobj(6)
+    with open(source_path, 'rb') as source, open(target_path, 'wb') as target:
+        for chunk in iter(partial(source.read, chunk_size), b''):
+            target.write(compressor.compress(chunk))
+        target.write(compressor.flush())
+
+
+def decompress_file(source_path, target_path, chunk_size=1024 * 1024):
+    decompressor = zlib.decompressobj()
+    with open(source_path, 'rb') as source, open(target_path, 'wb') as target:
+        for chunk in iter(partial(source.read, chunk_size), b''):
+            target.write(decompressor.decompress(chunk))
+        target.write(decompressor.flush())
+
+
+class UndoJournal:
+    # 持久化的撤销记录：每个修改过的文件只保存压缩后的差异和修改前后的内容哈希，可跨会话撤销和重做
+    def __init__(self, path=JOURNAL_PATH):
+        self.path = path
+        # 无法按差异保存的文件以压缩后的完整内容保存在此目录
+        self.blob_dir = os.path.splitext(path)[0] + '_files'
+        os.makedirs(self.blob_dir, exist_ok=True)
+        with self.connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, started TEXT, rules TEXT)")
+            conn.execute("CREATE TABLE IF NOT EXISTS entries ("
+                         "id INTEGER PRIMARY KEY, run_id INTEGER, path TEXT, kind TEXT, before_digest TEXT, "
+                         "after_digest TEXT, delta BLOB, state TEXT, UNIQUE (run_id, path))")
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def start_run(self, pairs):
+        with self.connect() as conn:
+            cursor = conn.execute("INSERT INTO runs (started, rules) VALUES (?, ?)",
+                                  (datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                                   json.dumps(list(pairs), ensure_ascii=False)))
+            return cursor.lastrowid
+
+    def blob_path(self, run_id, file_path, version):
+        digest = hashlib.sha1(os.path.abspath(file_path).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.blob_dir, f"{run_id}_{digest}.{version}.z")
+
+    def record(self, run_id, file_path, backup):
+        # backup 为修改前的副本，file_path 为修改后的文件
+        delta = make_delta(backup, file_path)
+        if delta is None:
+            kind, data = 'full', None
+            compress_file(backup, self.blob_path(run_id, file_path, 'before'))
+        else:
+            kind, data = delta[0], zlib.compress(pickle.dumps(delta, protocol=4))
+        with self.connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO entries (run_id, path, kind, before_digest, after_digest, delta, state) "
+                         "VALUES (?, ?, ?, ?, ?, ?, 'applied')",
+                         (run_id, file_path, kind, content_digest(backup), content_digest(file_path), data))
+
+    def discard(self, run_id, file_path):
+        with self.connect() as conn:
+            conn.execute("DELETE FROM entries WHERE run_id = ? AND path = ?", (run_id, file_path))
+        for version in ('before', 'after'):
+            blob = self.blob_path(run_id, file_path, version)
+            if os.path.exists(blob):
+                os.remove(blob)
+
+    def runs(self):
+        # 返回 [(编号, 时间, 规则, 已应用的文件数, 已撤销的文件数)]，最新的在前
+        with self.connect() as conn:
+            rows = conn.execute("SELECT runs.id, runs.started, runs.rules, "
+                                "SUM(entries.state = 'applied'), SUM(entries.state = 'undone') "
+                                "FROM runs JOIN entries ON entries.run_id = runs.id "
+                                "GROUP BY runs.id ORDER BY runs.id DESC").fetchall()
+        return [(run_id, started, json.loads(rules), applied, undone)
+                for run_id, started, rules, applied, undone in rows]
+
+    def latest_run(self):
+        with self.connect() as conn:
+            row = conn.execute("SELECT MAX(run_id) FROM entries WHERE state = 'applied'").fetchone()
+        return row[0]
+
+    def entries(self, run_id, state):
+        with self.connect() as conn:
+            return conn.execute("SELECT id, path, kind, before_digest, after_digest, delta FROM entries "
+                                "WHERE run_id = ? AND state = ?", (run_id, state)).fetchall()
+
+    def revert(self, run_id, entry, undo=True):
+        # 确认文件自上次操作后未被修改，在临时文件中还原并校验哈希后再替换原文件
+        entry_id, file_path, kind, before_digest, after_digest, data = entry
+        expected, wanted = (after_digest, before_digest) if undo else (before_digest, after_digest)
+        if not os.path.exists(file_path):
+            raise ValueError("文件已不存在")
+        if content_digest(file_path) != expected:
+            raise ValueError("文件在此之后已被修改")
+
+        temp_path = f"{file_path}.{os.getpid()}.{entry_id}.tmp"
+        try:
+            if kind == 'full':
+                # 第一次撤销时保存修改后的内容，供重做使用
+                after_blob = self.blob_path(run_id, file_path, 'after')
+                if undo and not os.path.exists(after_blob):
+                    compress_file(file_path, after_blob)
+                decompress_file(self.blob_path(run_id, file_path, 'before') if undo else after_blob, temp_path)
+            else:
+                apply_delta(pickle.loads(zlib.decompress(data)), file_path, temp_path, undo)
+            if content_digest(temp_path) != wanted:
+                raise ValueError("还原结果校验失败")
+            # 只复制权限，还原后的文件使用新的修改时间，索引和预览缓存据此识别内容已变化
+            shutil.copymode(file_path, temp_path)
+            os.replace(temp_path, file_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+        with self.connect() as conn:
+            conn.execute("UPDATE entries SET state = ? WHERE id = ?", ('undone' if undo else 'applied', entry_id))
+
+    def clear(self):
+        with self.connect() as conn:
+            conn.execute("DELETE FROM entries")
+            conn.execute("DELETE FROM runs")
+        shutil.rmtree(self.blob_dir, ignore_errors=True)
+        os.makedirs(self.blob_dir, exist_ok=True)
+
+
+class FileProcessor:
+    # 单个文件的处理逻辑，可在线程中直接调用，也可序列化后交给隔离的子进程执行
+    def __init__(self, rules, backup_dir, dry_run=False, output_dir=None, source_root=None, link_unchanged=True,
+                 csv_columns=None, journal=None, run_id=None):
+        self.rules = rules
+        self.backup_dir = backup_dir
+        # 原地修改时把差异写入撤销记录，写入后删除临时备份
+        self.journal = journal
+        self.run_id = run_id
+        # 扫描模式只读取和匹配，不备份也不保存
+        self.dry_run = dry_run
+        # 输出目录模式：结果按相对 source_root 的路径写入 output_dir，不修改原文件也不备份
+        self.output_dir = output_dir
+        self.source_root = source_root
+        self.link_unchanged = link_unchanged
+        # CSV/TSV 只替换表头中这些名称的列，为空时替换所有单元格
+        self.csv_columns = csv_columns
+
+    def process_file(self, file_path):
+        if self.dry_run:
+            return self.scan_file(file_path)
+
+        if not self.output_dir:
+            self.backup_file(file_path)
+        target_path = self.output_path(file_path)
 
         file_extension = os.path.splitext(file_path)[1].lower()
         if file_extension == '.docx':
-            return self.process_word(file_path)
+            changed, tally = self.process_word(file_path, target_path)
         elif file_extension == '.xlsx':
-            return self.process_excel(file_path)
+            changed, tally = self.process_excel(file_path, target_path)
+        elif file_extension in CSV_EXTENSIONS:
+            changed, tally = self.process_csv(file_path, target_path)
         elif file_extension in ['.txt', '.md']:
-            return self.process_text(file_path)
+            changed, tally = self.process_text(file_path, target_path)
         else:
             raise ValueError(f"Unsupported file type: {file_extension}")
 
-    def process_word(self, file_path):
+        if not changed:
+            self.place_unchanged(file_path)
+        self.commit(file_path, changed)
+        return changed, tally
+
+    def commit(self, file_path, changed):
+        if self.output_dir or self.journal is None:
+            return
+        backup = backup_path(self.backup_dir, file_path)
+        if changed:
+            self.journal.record(self.run_id, file_path, backup)
+        os.remove(backup)
+
+    def scan_file(self, file_path):
+        if os.path.splitext(file_path)[1].lower() in CSV_EXTENSIONS:
+            tally = MatchTally(self.rules, None)
+            with open(file_path, 'r', encoding='utf-8-sig', newline='') as file:
+                for row, columns in self.csv_rows(open_csv(file, file_path)[0]):
+                    for i in columns:
+                        tally.scan(row[i])
+            return tally.total > 0, tally
+        if os.path.splitext(file_path)[1].lower() == '.docx':
+            # 与替换时一样逐段匹配，匹配不会跨越段落
+            doc = Document(file_path)
+            tally = MatchTally(self.rules, document_text(doc))
+            for para in document_paragraphs(doc):
+                tally.scan(para.text)
+            return tally.total > 0, tally
+
+        content = extract_text(file_path)
+        tally = MatchTally(self.rules, content)
+        tally.scan(content)
+        return tally.total > 0, tally
+
+    def process_word(self, file_path, target_path):
         doc = Document(file_path)
-        changed = False
-        file_replacements = 0
-        for old_text, new_text in self.rules:
-            replacements = self.replace_text_in_document(doc, old_text, new_text)
-            if replacements > 0:
-                changed = True
-                file_replacements += replacements
+        tally = MatchTally(self.rules, document_text(doc))
+        self.replace_text_in_document(doc, tally)
+        changed = tally.total > 0
         if changed:
-            doc.save(file_path)
-        return changed, file_replacements
-
-    def process_excel(self, file_path):
-        changed = False
-        file_replacements = 0
+            doc.save(target_path)
+        return changed, tally
 
+    def process_excel(self, file_path, target_path):
         wb = openpyxl.load_workbook(file_path)
 
+        text_cells = []
         for sheet_name in wb.sheetnames:
             sheet = wb[sheet_name]
             for row in sheet.iter_rows():
                 for cell in row:
                     if cell.data_type == 's':
-                        original_value = cell.value
-                        new_value = original_value
-                        for old_text, new_text in self.rules:
-                            if old_text in new_value:
-                                new_value = new_value.replace(old_text, new_text)
-                        if new_value != original_value:
-                            cell.value = new_value
-                            changed = True
-                            file_replacements += 1
+                        text_cells.append(cell)
+
+        tally = MatchTally(self.rules, '\n'.join(cell.value for cell in text_cells))
+        for cell in text_cells:
+            new_value, replacements = tally.apply(cell.value)
+            if replacements:
+                cell.value = new_value
 
+        changed = tally.total > 0
         if changed:
-            wb.save(file_path)
+            wb.save(target_path)
 
-        return changed, file_replacements
+        return changed, tally
 
-    def process_text(self, file_path):
+    def process_text(self, file_path, target_path):
         with open(file_path, 'r', encoding='utf-8') as file:
             content = file.read()
 
-        changed = False
-        file_replacements = 0
-        for old_text, new_text in self.rules:
-            if old_text in content:
-                content = content.replace(old_text, new_text)
-                changed = True
-                file_replacements += content.count(new_text)
+        tally = MatchTally(self.rules, content)
+        content, replacements = tally.apply(content)
+        changed = replacements > 0
 
         if changed:
-            with open(file_path, 'w', encoding='utf-8') as file:
+            with open(target_path, 'w', encoding='utf-8') as file:
                 file.write(content)
 
-        return changed, file_replacements
+        return changed, tally
 
-    def replace_text_in_document(self, doc, old_text, new_text):
+    def process_csv(self, file_path, target_path):
+        # 逐行读取、替换并写入临时文件，内存占用与文件大小无关
+        tally = MatchTally(self.rules, None)
+        temp_path = f"{target_path}.{os.getpid()}.tmp"
+        encoding = 'utf-8-sig' if has_utf8_bom(file_path) else 'utf-8'
+        try:
+            with open(file_path, 'r', encoding='utf-8-sig', newline='') as source, \
+                    open(temp_path, 'w', encoding=encoding, newline='') as output:
+                lines = RawLines(source)
+                reader, dialect, lineterminator = open_csv(source, file_path, lines)
+                writer = csv.writer(output, dialect, lineterminator=lineterminator)
+                for row, columns in self.csv_rows(reader):
+                    replacements = 0
+                    for i in columns:
+                        row[i], count = tally.apply(row[i])
+                        replacements += count
+                    # 只重新生成有替换的记录，其余记录保留原有的引号和格式
+                    raw = lines.take()
+                    if replacements:
+                        writer.writerow(row)
+                    else:
+                        output.write(raw)
+            if tally.total > 0:
+                os.replace(temp_path, target_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return tally.total > 0, tally
+
+    def csv_rows(self, reader):
+        # 依次返回 (行, 需要处理的非空列)；指定了列名时第一行作为表头，不做替换
+        columns = None
+        for row_number, row in enumerate(reader):
+            if row_number == 0 and self.csv_columns:
+                columns = [i for i, name in enumerate(row) if name.strip() in self.csv_columns]
+                if not columns:
+                    return
+                yield row, []
+                continue
+            indices = range(len(row)) if columns is None else columns
+            yield row, [i for i in indices if i < len(row) and row[i]]
+
+    def replace_text_in_document(self, doc, tally):
         replacements = 0
-        for para in doc.paragraphs:
-            if old_text in para.text:
-                para.text = para.text.replace(old_text, new_text)
-                replacements += para.text.count(new_text)
-        for table in doc.tables:
-            for row in table.rows:
-                for cell in row.cells:
-                    if old_text in cell.text:
-                        cell.text = cell.text.replace(old_text, new_text)
-                        replacements += cell.text.count(new_text)
+        for para in document_paragraphs(doc):
+            replacements += self.replace_text_in_paragraph(para._p, tally)
         return replacements
 
+    def replace_text_in_paragraph(self, p, tally):
+        # 保留 run 的格式，只修改匹配涉及到的文本节点
+        pieces = paragraph_pieces(p)
+        matches = tally.matches(''.join(piece[3] for piece in pieces))
+        if not matches:
+            return 0
+        return edit_paragraph(pieces, matches, self.rules.new_text)
+
+    def apply_duplicate(self, source_path, file_path, changed):
+        if self.dry_run:
+            return
+        if not changed:
+            self.place_unchanged(file_path)
+            return
+        if not self.output_dir:
+            self.backup_file(file_path)
+        target_path = self.output_path(file_path)
+        clone_file(self.target_path(source_path), target_path)
+        self.commit(file_path, changed)
+
+    def target_path(self, file_path):
+        if not self.output_dir:
+            return file_path
+        target_path = os.path.join(self.output_dir, os.path.relpath(file_path, self.source_root))
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        return target_path
+
+    def output_path(self, file_path):
+        # 输出目录中已有的文件可能是上次创建的、指向原文件的硬链接，写入前先删除，避免改动原文件
+        target_path = self.target_path(file_path)
+        if self.output_dir and os.path.lexists(target_path):
+            os.remove(target_path)
+        return target_path
+
+    def place_unchanged(self, file_path):
+        if self.output_dir and self.link_unchanged:
+            link_or_copy(file_path, self.target_path(file_path))
+
+    def backup_file(self, file_path):
+        # 备份只在处理期间使用，支持时用写时复制克隆
+        clone_file(file_path, backup_path(self.backup_dir, file_path))
+
+    def recover(self, file_path):
+        # 处理被中断后恢复原状：原地模式从备份还原，输出目录模式删除写了一半的结果
+        if self.dry_run:
+            return
+        if self.output_dir:
+            target_path = self.target_path(file_path)
+            if os.path.exists(target_path):
+                os.remove(target_path)
+            return
+        backup = backup_path(self.backup_dir, file_path)
+        if os.path.exists(backup):
+            shutil.copy2(backup, file_path)
+            if self.journal is not None:
+                self.journal.discard(self.run_id, file_path)
+                os.remove(backup)
+
+
+class ReplacementWorker(QThread):
+    progress = pyqtSignal(int)
+    file_processed = pyqtSignal(str, bool, int)
+    file_scanned = pyqtSignal(str, list)
+    file_quarantined = pyqtSignal(str, str)
+    file_failed = pyqtSignal(str, str)
+    finished = pyqtSignal(dict)
+
+    def __init__(self, files, rules, backup_dir, max_workers=None, corpus_index=None, dry_run=False,
+                 output_dir=None, source_root=None, link_unchanged=True, isolation=None, auto_tune=False,
+                 csv_columns=None, journal=None, run_id=None):
+        super().__init__()
+        self.files = files
+        self.rules = rules
+        self.max_workers = max_workers or os.cpu_count()
+        # 自动模式下分别调整 I/O 阶段（为查找重复文件计算哈希）和 CPU 阶段（解析、替换、保存）的并发数
+        self.auto_tune = auto_tune
+        self.corpus_index = corpus_index
+        self.dry_run = dry_run
+        self.output_dir = output_dir
+        self.processor = FileProcessor(rules, backup_dir, dry_run, output_dir, source_root, link_unchanged,
+                                       csv_columns, journal, run_id)
+        # isolation 为 (超时秒数, 内存上限字节数) 时每个文件在独立子进程中处理
+        self.isolation = isolation
+
+    def run(self):
+        # 之前被隔离且之后未修改的文件直接跳过
+        quarantine = load_quarantine()
+        quarantined = []
+        files = []
+        for file_path in self.files:
+            reason = quarantine_reason(quarantine, file_path)
+            if reason:
+                quarantined.append([file_path, reason])
+                self.file_quarantined.emit(file_path, f"之前已被隔离：{reason}")
+            else:
+                files.append(file_path)
+        unquarantined = files
+
+        io_tuner, cpu_tuner, tune_key = self.create_tuners(files)
+
+        if self.corpus_index is not None:
+            # 先用全文索引筛出可能命中的文件，其余文件无需打开
+            files = self.update_index(files, cpu_tuner, quarantine, quarantined)
+            unquarantined = files
+            files = self.corpus_index.candidate_files(self.rules, files)
+            if self.output_dir and not self.dry_run:
+                candidates = set(files)
+                for file_path in unquarantined:
+                    if file_path not in candidates:
+                        self.processor.place_unchanged(file_path)
+
+        total_files = len(files)
+        stats = {
+            "total_files": len(self.files),
+            "skipped_files": len(unquarantined) - total_files,
+            "quarantined": quarantined,
+            "deduplicated_files": 0,
+            "deduplicated_bytes": 0,
+            "changed_files": 0,
+            "total_replacements": 0,
+            "rule_hits": {},
+            "rule_files": {},
+            "rule_seconds": {},
+            "shared_rule_seconds": 0.0
+        }
+
+        # 内容完全相同的文件只处理一次，结果复制给同组的其他文件
+        groups = group_duplicates(files, io_tuner)
+        done = 0
+
+        for group, (status, value) in self.iter_results(groups, cpu_tuner):
+            cpu_tuner.completed()
+            if status == 'ok':
+                changed, tally = value
+                self.record_tally(stats, tally)
+                self.report_file(stats, group[0], changed, tally)
+                for file_path in group[1:]:
+                    try:
+                        size = os.path.getsize(file_path)
+                        self.processor.apply_duplicate(group[0], file_path, changed)
+                    except Exception as e:
+                        self.recover(file_path)
+                        self.file_failed.emit(file_path, f"复制重复文件的处理结果失败: {str(e)}")
+                        self.file_processed.emit(file_path, False, 0)
+                        continue
+                    self.record_tally(stats, tally, include_time=False)
+                    self.report_file(stats, file_path, changed, tally)
+                    stats["deduplicated_files"] += 1
+                    stats["deduplicated_bytes"] += size
+            elif status == 'error':
+                # 出错时文件可能已被改写（例如保存了一半或写入撤销记录失败），从备份恢复原状
+                self.recover(group[0])
+                for file_path in group:
+                    self.file_failed.emit(file_path, value)
+                    self.file_processed.emit(file_path, False, 0)
+            else:
+                # 超时、超出内存或进程崩溃：恢复原文件并隔离，同组的副本内容相同，一并隔离
+                self.recover(group[0])
+                for file_path in group:
+                    quarantine_file(quarantine, file_path, value)
+                    stats["quarantined"].append([file_path, value])
+                    self.file_quarantined.emit(file_path, value)
+            done += len(group)
+            self.progress.emit(int(done / total_files * 100))
+
+        if quarantine != load_quarantine():
+            try:
+                save_quarantine(quarantine)
+            except OSError:
+                pass
+        stats["concurrency"] = {"io": io_tuner.level, "cpu": cpu_tuner.level, "tuned": False}
+        if tune_key is not None:
+            io_tuner.finish()
+            cpu_tuner.finish()
+            measured = {name: tuner.level for name, tuner in (("io", io_tuner), ("cpu", cpu_tuner)) if tuner.measured}
+            stats["concurrency"].update(io=io_tuner.level, cpu=cpu_tuner.level, tuned=bool(measured))
+            if measured:
+                try:
+                    save_concurrency(tune_key, measured)
+                except OSError:
+                    pass
+
+        if not files:
+            self.progress.emit(100)
+        self.finished.emit(stats)
+
+    def update_index(self, files, tuner, quarantine, quarantined):
+        # 提取文本同样可能卡住或耗尽内存；启用隔离时在子进程中提取，出问题的文件按同样规则隔离并跳过
+        if self.isolation is None:
+            self.corpus_index.update(files, tuner.level)
+            return files
+        stale = {entry[0]: entry for entry in self.corpus_index.stale_files(files)}
+        timeout, memory_limit = self.isolation
+        pool = IsolatedPool(TextExtractor(), tuner, timeout, memory_limit)
+        contents = []
+        failed = set()
+        for file_path, (status, value) in pool.map_unordered(list(stale)):
+            if status in ('ok', 'error'):
+                contents.append((stale[file_path], value if status == 'ok' else None))
+            else:
+                failed.add(file_path)
+                quarantine_file(quarantine, file_path, value)
+                quarantined.append([file_path, value])
+                self.file_quarantined.emit(file_path, value)
+        self.corpus_index.store(contents)
+        return [file_path for file_path in files if file_path not in failed]
+
+    def recover(self, file_path):
+        try:
+            self.processor.recover(file_path)
+        except (OSError, sqlite3.Error):
+            pass
+
+    def create_tuners(self, files):
+        # 返回 (I/O 调节器, CPU 调节器, 需要保存结果时的键)
+        cpu_count = os.cpu_count() or 1
+        if not self.auto_tune:
+            return ConcurrencyTuner(self.max_workers, self.max_workers), \
+                ConcurrencyTuner(self.max_workers, self.max_workers), None
+
+        io_maximum = min(32, cpu_count * 4)
+        key = workload_key(files) if files else None
+        saved = load_concurrency().get(key, {}) if key else {}
+        tune_items = int(len(files) * AUTOTUNE_FRACTION) if len(files) >= AUTOTUNE_MIN_FILES else 0
+        # 已保存的阶段直接使用保存的并发数；之前没有测量到的阶段（例如没有大小相同的文件需要计算哈希）继续测量
+        io_tuner = ConcurrencyTuner(saved.get("io", cpu_count), io_maximum, 0 if "io" in saved else tune_items)
+        cpu_tuner = ConcurrencyTuner(saved.get("cpu", max(cpu_count // 2, 1)), cpu_count,
+                                     0 if "cpu" in saved else tune_items)
+        return io_tuner, cpu_tuner, key if io_tuner.tuning or cpu_tuner.tuning else None
+
+    def iter_results(self, groups, tuner):
+        # 依次返回 (文件组, (状态, 结果))；状态为 ok、error、timeout、memory 或 crash
+        if self.isolation is None:
+            # 同时进行的任务数不超过调节器给出的并发数
+            pending = deque(groups)
+            future_to_group = {}
+            with concurrent.futures.ThreadPoolExecutor(max_workers=tuner.maximum) as executor:
+                while pending or future_to_group:
+                    while pending and len(future_to_group) < tuner.level:
+                        group = pending.popleft()
+                        future_to_group[executor.submit(self.processor.process_file, group[0])] = group
+                    done, _ = concurrent.futures.wait(future_to_group, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        group = future_to_group.pop(future)
+                        try:
+                            outcome = ('ok', future.result())
+                        except Exception as e:
+                            outcome = ('error', str(e))
+                        yield group, outcome
+        else:
+            timeout, memory_limit = self.isolation
+            pool = IsolatedPool(self.processor, tuner, timeout, memory_limit)
+            group_by_path = {group[0]: group for group in groups}
+            for file_path, outcome in pool.map_unordered(list(group_by_path)):
+                yield group_by_path[file_path], outcome
+
+    def report_file(self, stats, file_path, changed, tally):
+        if self.dry_run and tally.counts:
+            self.file_scanned.emit(file_path, tally.matrix_row())
+        if changed:
+            stats["changed_files"] += 1
+            stats["total_replacements"] += tally.total
+            self.file_processed.emit(file_path, True, tally.total)
+        else:
+            self.file_processed.emit(file_path, False, 0)
+
+    def record_tally(self, stats, tally, include_time=True):
+        for rule_id, count in tally.counts.items():
+            stats["rule_hits"][rule_id] = stats["rule_hits"].get(rule_id, 0) + count
+            stats["rule_files"][rule_id] = stats["rule_files"].get(rule_id, 0) + 1
+        if include_time:
+            for rule_id, seconds in tally.rule_seconds().items():
+                stats["rule_seconds"][rule_id] = stats["rule_seconds"].get(rule_id, 0.0) + seconds
+            stats["shared_rule_seconds"] += tally.shared_seconds()
+
+
+class FanOutTemplate:
+    # 模板只解析一次并预先定位占位符，之后每行数据只需拼接文本并写出文件
+    def __init__(self, template_path, placeholders):
+        self.template_path = template_path
+        self.extension = os.path.splitext(template_path)[1].lower()
+        self.placeholders = placeholders
+        self.pattern = self.compile_pattern(placeholders)
+
+        if self.extension in ['.txt', '.md']:
+            with open(template_path, 'r', encoding='utf-8') as file:
+                content = file.read()
+            self.base = None
+            self.parts = [(None, self.split(content))]
+        elif self.extension in ['.docx', '.xlsx']:
+            self.base, self.parts = self.split_package(self.prepare_package())
+        else:
+            raise ValueError(f"Unsupported file type: {self.extension}")
+
+    def compile_pattern(self, texts):
+        # 与替换规则一致：最左最长匹配
+        lookup = {text: column for column, text in enumerate(texts)}
+        alternatives = sorted(lookup, key=len, reverse=True)
+        return re.compile('|'.join(map(re.escape, alternatives))), lookup
+
+    def prepare_package(self):
+        # 经 python-docx / openpyxl 保存一次，使被拆分到多个 run 的占位符合并为连续文本
+        buffer = io.BytesIO()
+        if self.extension == '.docx':
+            doc = Document(self.template_path)
+            paragraphs = list(doc.paragraphs)
+            for table in doc.tables:
+                for row in table.rows:
+                    for cell in row.cells:
+                        paragraphs.extend(cell.paragraphs)
+            regex, _ = self.pattern
+            for para in paragraphs:
+                # 只把被拆分到多个文本节点的占位符合并到第一个节点，其余 run 及其格式保持不变
+                pieces = paragraph_pieces(para._p)
+                text = ''.join(piece[3] for piece in pieces)
+                matches = [(match.start(), match.end(), match.group()) for match in regex.finditer(text)
+                           if sum(1 for piece in pieces if piece[1] < match.end() and piece[2] > match.start()) > 1]
+                if matches:
+                    edit_paragraph(pieces, matches, lambda placeholder: placeholder)
+            doc.save(buffer)
+        else:
+            wb = openpyxl.load_workbook(self.template_path)
+            wb.save(buffer)
+        return buffer.getvalue()
+
+    def split_package(self, package):
+        # 不含占位符的部件预先压缩成基础包，生成时直接复制；含占位符的部件拆分为片段
+        base = io.BytesIO()
+        parts = []
+        with zipfile.ZipFile(io.BytesIO(package)) as source, zipfile.ZipFile(base, 'w', zipfile.ZIP_DEFLATED) as target:
+            for info in source.infolist():
+                data = source.read(info)
+                if info.filename.endswith('.xml'):
+                    segments = self.split_xml(data.decode('utf-8'))
+                    if len(segments) > 1:
+                        parts.append((info.filename, segments))
+                        continue
+                target.writestr(info, data)
+        return base.getvalue(), parts
+
+    def split(self, text):
+        # 返回文本片段和列号交替的列表
+        regex, lookup = self.pattern
+        segments = []
+        last = 0
+        for match in regex.finditer(text):
+            segments.append(text[last:match.start()])
+            segments.append(lookup[match.group()])
+            last = match.end()
+        segments.append(text[last:])
+        return segments
+
+    def split_xml(self, text):
+        # 只在元素文本内查找；文本中的实体和字符引用（如 openpyxl 写出的 &#22995;）先解码再匹配
+        segments = []
+        last = 0
+        for node in re.finditer(r'>([^<]+)<', text):
+            value = html.unescape(node.group(1))
+            parts = self.split(value)
+            if len(parts) == 1:
+                continue
+            segments.append(text[last:node.start(1)])
+            segments.extend(part if isinstance(part, int) else escape(part) for part in parts)
+            last = node.end(1)
+        segments.append(text[last:])
+        return segments
+
+    def join(self, segments, values):
+        return ''.join(segment if isinstance(segment, str) else values[segment] for segment in segments)
+
+    def render(self, values):
+        if self.base is None:
+            return self.join(self.parts[0][1], values).encode('utf-8')
+        escaped = [escape(value) for value in values]
+        buffer = io.BytesIO(self.base)
+        with zipfile.ZipFile(buffer, 'a', zipfile.ZIP_DEFLATED) as package:
+            for name, segments in self.parts:
+                package.writestr(name, self.join(segments, escaped))
+        return buffer.getvalue()
+
+
+class FanOutWorker(QThread):
+    progress = pyqtSignal(int)
+    file_generated = pyqtSignal(str, bool)
+    finished = pyqtSignal(dict)
+
+    def __init__(self, template_path, data_path, output_dir, max_workers=None):
+        super().__init__()
+        self.template_path = template_path
+        self.data_path = data_path
+        self.output_dir = output_dir
+        self.max_workers = max_workers or os.cpu_count()
+
+    def open_data(self, file):
+        return open_csv(file, self.data_path)[0]
+
+    def run(self):
+        stats = {"total_rows": 0, "generated_files": 0, "failed_files": 0, "error": None}
+        try:
+            with open(self.data_path, 'r', encoding='utf-8-sig', newline='') as file:
+                total_rows = max(sum(1 for _ in self.open_data(file)) - 1, 0)
+            with open(self.data_path, 'r', encoding='utf-8-sig', newline='') as file:
+                reader = self.open_data(file)
+                header = next(reader, [])
+                columns = [i for i, name in enumerate(header) if name and name != FANOUT_FILENAME_COLUMN]
+                name_column = header.index(FANOUT_FILENAME_COLUMN) if FANOUT_FILENAME_COLUMN in header else None
+                if not columns:
+                    raise ValueError("数据表第一行需要包含占位符")
+                template = FanOutTemplate(self.template_path, [header[i] for i in columns])
+                stats["total_rows"] = total_rows
+                self.generate(template, reader, columns, name_column, stats)
+        except Exception as e:
+            stats["error"] = str(e)
+        self.finished.emit(stats)
+
+    def generate(self, template, reader, columns, name_column, stats):
+        # 逐行读取数据并限制同时进行的任务数，输出随生成随写入
+        os.makedirs(self.output_dir, exist_ok=True)
+        stem = os.path.splitext(os.path.basename(self.template_path))[0]
+        used_names = set()
+        pending = deque()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for row_number, row in enumerate(reader, 1):
+                values = [row[i] if i < len(row) else '' for i in columns]
+                name = row[name_column].strip() if name_column is not None and name_column < len(row) else ''
+                output_path = self.output_path(name or f"{stem}_{row_number}", template.extension, used_names)
+                pending.append((output_path, executor.submit(self.write_variant, template, values, output_path)))
+                if len(pending) >= self.max_workers * 4:
+                    self.collect(pending.popleft(), stats)
+            while pending:
+                self.collect(pending.popleft(), stats)
+
+    def output_path(self, name, extension, used_names):
+        name = re.sub(r'[\\/:*?"<>|]', '_', name)
+        candidate = name
+        suffix = 1
+        while candidate in used_names:
+            suffix += 1
+            candidate = f"{name}_{suffix}"
+        used_names.add(candidate)
+        return os.path.join(self.output_dir, candidate + extension)
+
+    def write_variant(self, template, values, output_path):
+        data = template.render(values)
+        with open(output_path, 'wb') as file:
+            file.write(data)
+
+    def collect(self, item, stats):
+        output_path, future = item
+        try:
+            future.result()
+            stats["generated_files"] += 1
+            self.file_generated.emit(output_path, True)
+        except Exception:
+            stats["failed_files"] += 1
+            self.file_generated.emit(output_path, False)
+        done = stats["generated_files"] + stats["failed_files"]
+        self.progress.emit(int(done / max(stats["total_rows"], 1) * 100))
+
+
+class PreviewWorker(QThread):
+    # 在后台提取选中文件的文本并标出当前规则的所有匹配，结果以 HTML 返回
+    preview_ready = pyqtSignal(int, str, str, str)
+
+    def __init__(self, generation, file_path, pairs, text=None, corpus_index=None):
+        super().__init__()
+        self.generation = generation
+        self.file_path = file_path
+        self.pairs = pairs
+        self.text = text
+        self.corpus_index = corpus_index
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        try:
+            text = self.text
+            if text is None and self.corpus_index is not None:
+                text = self.corpus_index.cached_text(self.file_path)
+            if text is None and os.path.splitext(self.file_path)[1].lower() in CSV_EXTENSIONS:
+                # 数据表只读取开头部分，命中次数也只统计这一部分
+                with open(self.file_path, 'r', encoding='utf-8-sig') as file:
+                    text = file.read(PREVIEW_CHAR_LIMIT + 1)
+            if text is None:
+                text = extract_text(self.file_path)
+            if self.cancelled:
+                return
+            preview_html = self.highlight(text)
+        except ValueError:
+            text, preview_html = '', "不支持的文件类型"
+        except Exception as e:
+            text, preview_html = '', escape(f"无法预览文件: {str(e)}")
+        if preview_html is not None and not self.cancelled:
+            self.preview_ready.emit(self.generation, self.file_path, text, preview_html)
+
+    def rule_set(self):
+        fingerprint = rule_set_fingerprint(self.pairs)
+        rule_set = _preview_rule_sets.pop(fingerprint, None)
+        if rule_set is None:
+            rule_set = RuleSet.from_pairs(self.pairs, analyze=False)
+        _preview_rule_sets[fingerprint] = rule_set
+        while len(_preview_rule_sets) > 4:
+            _preview_rule_sets.pop(next(iter(_preview_rule_sets)), None)
+        return rule_set
+
+    def highlight(self, text):
+        if self.cancelled:
+            return None
+        rule_set = self.rule_set()
+        if self.cancelled:
+            return None
+        counts = {}
+        parts = []
+        position = 0
+        if len(rule_set):
+            for number, (start, end, rule_id) in enumerate(rule_set.matcher(text).finditer(text)):
+                if number % 1000 == 0 and self.cancelled:
+                    return None
+                counts[rule_id] = counts.get(rule_id, 0) + 1
+                if start >= PREVIEW_CHAR_LIMIT:
+                    continue
+                color = PREVIEW_COLORS[rule_id % len(PREVIEW_COLORS)]
+                parts.append(escape(text[position:start]))
+                parts.append(f'<span style="background-color: {color}; color: black;">{escape(text[start:end])}</span>')
+                position = end
+        parts.append(escape(text[position:max(position, PREVIEW_CHAR_LIMIT)]))
+
+        summary = []
+        for rule_id, count in sorted(counts.items(), key=lambda item: -item[1]):
+            color = PREVIEW_COLORS[rule_id % len(PREVIEW_COLORS)]
+            summary.append(f'<span style="background-color: {color}; color: black;">'
+                           f'{escape(rule_set.old_text(rule_id))}</span> → '
+                           f'{escape(rule_set.new_text(rule_id))}：{count} 处')
+        header = f"<p><b>共 {sum(counts.values())} 处匹配</b>"
+        if len(text) > PREVIEW_CHAR_LIMIT and os.path.splitext(self.file_path)[1].lower() in CSV_EXTENSIONS:
+            header += f"（仅统计前 {PREVIEW_CHAR_LIMIT} 个字符）"
+        if summary:
+            header += "<br>" + "<br>".join(summary)
+        header += "</p><hr>"
+        if len(text) > PREVIEW_CHAR_LIMIT:
+            parts.append(f"<br><i>……仅显示前 {PREVIEW_CHAR_LIMIT} 个字符</i>")
+        return header + '<div style="white-space: pre-wrap;">' + ''.join(parts) + "</div>"
+
+
+class RestoreWorker(QThread):
+    # 并行撤销或重做一次替换，只处理自该次操作后未被修改的文件
+    progress = pyqtSignal(int)
+    file_restored = pyqtSignal(str, bool, str)
+    finished = pyqtSignal(dict)
+
+    def __init__(self, journal, run_id, undo=True, max_workers=None):
+        super().__init__()
+        self.journal = journal
+        self.run_id = run_id
+        self.undo = undo
+        self.max_workers = max_workers or os.cpu_count()
+
+    def run(self):
+        entries = self.journal.entries(self.run_id, 'applied' if self.undo else 'undone')
+        stats = {"total_files": len(entries), "restored_files": 0, "failed_files": 0}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            future_to_entry = {executor.submit(self.journal.revert, self.run_id, entry, self.undo): entry
+                               for entry in entries}
+            for done, future in enumerate(concurrent.futures.as_completed(future_to_entry), 1):
+                file_path = future_to_entry[future][1]
+                try:
+                    future.result()
+                    stats["restored_files"] += 1
+                    self.file_restored.emit(file_path, True, "")
+                except Exception as e:
+                    stats["failed_files"] += 1
+                    self.file_restored.emit(file_path, False, str(e))
+                self.progress.emit(int(done / len(entries) * 100))
+        if not entries:
+            self.progress.emit(100)
+        self.finished.emit(stats)
+
+
 class LoadingDialog(QDialog):
     def __init__(self, parent=None):
         super().__init__(parent)
@@ -158,11 +2093,194 @@ class LoadingDialog(QDialog):
     def update_progress(self, value):
         self.progress_bar.setValue(value)
 
+class RuleReportDialog(QDialog):
+    def __init__(self, rule_set, stats, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("规则效果报告")
+        self.resize(800, 500)
+        self.rule_set = rule_set
+        self.stats = stats
+        layout = QVBoxLayout(self)
+
+        dead_rules = self.dead_rules()
+        layout.addWidget(QLabel(f"规则总数: {len(rule_set)}    未命中规则: {len(dead_rules)}"))
+
+        self.table = QTableWidget(len(rule_set), 5, self)
+        self.table.setHorizontalHeaderLabels(['要替换的文本', '新文本', '命中次数', '涉及文件数', '耗时 (毫秒)'])
+        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeMode.Stretch)
+        self.table.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
+        for row, (rule_id, old_text, new_text, hits, files, seconds) in enumerate(self.rows()):
+            self.table.setItem(row, 0, QTableWidgetItem(old_text))
+            self.table.setItem(row, 1, QTableWidgetItem(new_text))
+            for column, value in ((2, hits), (3, files), (4, round(seconds * 1000, 3))):
+                item = QTableWidgetItem()
+                item.setData(Qt.ItemDataRole.DisplayRole, value)
+                self.table.setItem(row, column, item)
+        self.table.setSortingEnabled(True)
+        layout.addWidget(self.table)
+
+        buttons = QDialogButtonBox(self)
+        export_button = buttons.addButton("导出报告", QDialogButtonBox.ButtonRole.ActionRole)
+        export_button.clicked.connect(self.export_report)
+        self.prune_button = buttons.addButton("移除未命中的规则", QDialogButtonBox.ButtonRole.ActionRole)
+        self.prune_button.setEnabled(bool(dead_rules))
+        self.prune_button.clicked.connect(self.accept)
+        buttons.addButton(QDialogButtonBox.StandardButton.Close)
+        buttons.rejected.connect(self.reject)
+        layout.addWidget(buttons)
+
+    def rows(self):
+        for rule_id, (old_text, new_text) in enumerate(self.rule_set):
+            yield (rule_id, old_text, new_text,
+                   self.stats["rule_hits"].get(rule_id, 0),
+                   self.stats["rule_files"].get(rule_id, 0),
+                   self.stats["rule_seconds"].get(rule_id, 0.0) + self.stats["shared_rule_seconds"])
+
+    def dead_rules(self):
+        return [self.rule_set.old_text(rule_id) for rule_id in range(len(self.rule_set))
+                if rule_id not in self.stats["rule_hits"]]
+
+    def export_report(self):
+        file_name, _ = QFileDialog.getSaveFileName(self, "导出报告", "", "CSV Files (*.csv)")
+        if file_name:
+            try:
+                with open(file_name, 'w', encoding='utf-8-sig', newline='') as f:
+                    writer = csv.writer(f)
+                    writer.writerow(['要替换的文本', '新文本', '命中次数', '涉及文件数', '耗时 (毫秒)'])
+                    for rule_id, old_text, new_text, hits, files, seconds in self.rows():
+                        writer.writerow([old_text, new_text, hits, files, round(seconds * 1000, 3)])
+            except OSError as e:
+                self.parent().show_styled_message_box("警告", f"导出报告失败：{str(e)}", QMessageBox.Icon.Warning)
+
+
+class ScanResultsDialog(QDialog):
+    HEADERS = ['文件', '要替换的文本', '新文本', '命中次数', '上下文示例']
+
+    def __init__(self, rule_set, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("扫描结果（未修改任何文件）")
+        self.resize(1000, 600)
+        self.rule_set = rule_set
+        self.results = []
+        layout = QVBoxLayout(self)
+
+        self.summary_label = QLabel("正在扫描...")
+        layout.addWidget(self.summary_label)
+
+        self.table = QTableWidget(0, len(self.HEADERS), self)
+        self.table.setHorizontalHeaderLabels(self.HEADERS)
+        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeMode.Interactive)
+        self.table.horizontalHeader().setStretchLastSection(True)
+        self.table.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
+        layout.addWidget(self.table)
+
+        buttons = QDialogButtonBox(self)
+        export_button = buttons.addButton("导出结果", QDialogButtonBox.ButtonRole.ActionRole)
+        export_button.clicked.connect(self.export_results)
+        buttons.addButton(QDialogButtonBox.StandardButton.Close)
+        buttons.rejected.connect(self.reject)
+        layout.addWidget(buttons)
+
+    def add_file_result(self, file_path, matches):
+        for rule_id, count, snippets in matches:
+            result = (file_path, self.rule_set.old_text(rule_id), self.rule_set.new_text(rule_id), count,
+                      ' … '.join(snippets))
+            self.results.append(result)
+            row = self.table.rowCount()
+            self.table.insertRow(row)
+            for column, value in enumerate(result):
+                item = QTableWidgetItem()
+                item.setData(Qt.ItemDataRole.DisplayRole, value)
+                self.table.setItem(row, column, item)
+        self.summary_label.setText(f"正在扫描... 已找到 {len(self.results)} 项匹配")
+
+    def scan_finished(self, stats):
+        self.table.setSortingEnabled(True)
+        self.summary_label.setText(f"扫描完成：{stats['total_files']} 个文件中有 {stats['changed_files']} 个文件会被修改，"
+                                   f"共 {stats['total_replacements']} 处替换")
+
+    def export_results(self):
+        file_name, _ = QFileDialog.getSaveFileName(self, "导出结果", "", "CSV Files (*.csv)")
+        if file_name:
+            try:
+                with open(file_name, 'w', encoding='utf-8-sig', newline='') as f:
+                    writer = csv.writer(f)
+                    writer.writerow(self.HEADERS)
+                    writer.writerows(self.results)
+            except OSError as e:
+                self.parent().show_styled_message_box("警告", f"导出结果失败：{str(e)}", QMessageBox.Icon.Warning)
+
+
+class JournalDialog(QDialog):
+    HEADERS = ['编号', '时间', '已应用的文件', '已撤销的文件', '规则']
+
+    def __init__(self, journal, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("替换历史")
+        self.resize(900, 500)
+        self.journal = journal
+        # 选择的操作：(编号, 是否撤销)
+        self.selected = None
+        layout = QVBoxLayout(self)
+        layout.addWidget(QLabel("可撤销或重做任意一次替换；自该次操作后被修改过的文件不会被还原。"))
+
+        self.table = QTableWidget(0, len(self.HEADERS), self)
+        self.table.setHorizontalHeaderLabels(self.HEADERS)
+        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeMode.ResizeToContents)
+        self.table.horizontalHeader().setStretchLastSection(True)
+        self.table.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
+        self.table.setSelectionBehavior(QAbstractItemView.SelectionBehavior.SelectRows)
+        self.table.setSelectionMode(QAbstractItemView.SelectionMode.SingleSelection)
+        layout.addWidget(self.table)
+        self.load_runs()
+
+        buttons = QDialogButtonBox(self)
+        undo_button = buttons.addButton("撤销所选", QDialogButtonBox.ButtonRole.ActionRole)
+        undo_button.clicked.connect(lambda: self.choose(True))
+        redo_button = buttons.addButton("重做所选", QDialogButtonBox.ButtonRole.ActionRole)
+        redo_button.clicked.connect(lambda: self.choose(False))
+        clear_button = buttons.addButton("清空历史", QDialogButtonBox.ButtonRole.ActionRole)
+        clear_button.clicked.connect(self.clear_history)
+        buttons.addButton(QDialogButtonBox.StandardButton.Close)
+        buttons.rejected.connect(self.reject)
+        layout.addWidget(buttons)
+
+    def load_runs(self):
+        self.runs = self.journal.runs()
+        self.table.setRowCount(len(self.runs))
+        for row, (run_id, started, rules, applied, undone) in enumerate(self.runs):
+            summary = '；'.join(f"{old_text} → {new_text}" for old_text, new_text in rules[:3])
+            if len(rules) > 3:
+                summary += f" 等 {len(rules)} 条"
+            for column, value in enumerate((run_id, started, applied, undone, summary)):
+                self.table.setItem(row, column, QTableWidgetItem(str(value)))
+
+    def choose(self, undo):
+        rows = self.table.selectionModel().selectedRows()
+        if not rows:
+            return
+        run_id, _, _, applied, undone = self.runs[rows[0].row()]
+        if (applied if undo else undone):
+            self.selected = (run_id, undo)
+            self.accept()
+
+    def clear_history(self):
+        confirm = self.parent().show_styled_message_box("清空历史", "清空后将无法撤销之前的替换，是否继续？",
+                                                        QMessageBox.Icon.Question,
+                                                        QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No)
+        if confirm == QMessageBox.StandardButton.Yes:
+            self.journal.clear()
+            self.load_runs()
+
+
 class MultiFormatReplacerApp(QMainWindow):
     def __init__(self):
         super().__init__()
         self.initUI()
-        self.replacement_history = []
+        self.last_rule_report = None
+        self.corpus_index = None
+        self.journal = None
+        self.scan_worker = None
         self.temp_dir = tempfile.mkdtemp()
         self.file_set = set()
 
@@ -172,6 +2290,17 @@ class MultiFormatReplacerApp(QMainWindow):
         self.search_timer.setSingleShot(True)
         self.search_timer.timeout.connect(self.update_file_list)
 
+        # 编辑规则后延迟刷新预览中的匹配高亮，连续输入只触发一次
+        self.preview_generation = 0
+        self.preview_worker = None
+        self.preview_workers = set()
+        self.preview_texts = {}
+        self.preview_timer = QTimer()
+        self.preview_timer.setSingleShot(True)
+        self.preview_timer.timeout.connect(self.update_preview)
+        self.rules_table.itemChanged.connect(self.schedule_preview)
+        self.rules_table.model().rowsRemoved.connect(self.schedule_preview)
+
         self.is_dark_mode = False
         self.set_style()
 
@@ -217,10 +2346,22 @@ class MultiFormatReplacerApp(QMainWindow):
         replace_action.triggered.connect(self.replace_text)
         toolbar.addAction(replace_action)
 
+        scan_action = QAction(QIcon(self.style().standardIcon(QStyle.StandardPixmap.SP_FileDialogContentsView)), "扫描预览", self)
+        scan_action.triggered.connect(self.scan_text)
+        toolbar.addAction(scan_action)
+
+        fan_out_action = QAction(QIcon(self.style().standardIcon(QStyle.StandardPixmap.SP_FileDialogDetailedView)), "模板批量生成", self)
+        fan_out_action.triggered.connect(self.fan_out_template)
+        toolbar.addAction(fan_out_action)
+
         undo_action = QAction(QIcon(self.style().standardIcon(QStyle.StandardPixmap.SP_ArrowBack)), "撤销上次替换", self)
         undo_action.triggered.connect(self.undo_last_replacement)
         toolbar.addAction(undo_action)
 
+        history_action = QAction(QIcon(self.style().standardIcon(QStyle.StandardPixmap.SP_FileDialogListView)), "替换历史", self)
+        history_action.triggered.connect(self.show_history)
+        toolbar.addAction(history_action)
+
         # 创建主分割器
         main_splitter = QSplitter(Qt.Orientation.Horizontal)
         main_layout.addWidget(main_splitter)
@@ -249,7 +2390,8 @@ class MultiFormatReplacerApp(QMainWindow):
         filter_layout = QVBoxLayout()
         filter_layout.addWidget(QLabel("文件类型过滤:"))
         self.file_type_filter = QComboBox()
-        self.file_type_filter.addItems(["所有文件", "Word (.docx)", "Excel (.xlsx)", "文本 (.txt)", "Markdown (.md)"])
+        self.file_type_filter.addItems(["所有文件", "Word (.docx)", "Excel (.xlsx)", "文本 (.txt)", "Markdown (.md)",
+                                        "CSV (.csv)", "TSV (.tsv)"])
         self.file_type_filter.currentIndexChanged.connect(self.update_file_list)
         filter_layout.addWidget(self.file_type_filter)
 
@@ -315,6 +2457,9 @@ class MultiFormatReplacerApp(QMainWindow):
         remove_rule_button.setIcon(QIcon(self.style().standardIcon(QStyle.StandardPixmap.SP_DialogDiscardButton)))
         remove_rule_button.clicked.connect(self.remove_rule)
 
+        rule_report_button = QPushButton('规则报告')
+        rule_report_button.clicked.connect(self.show_rule_report)
+
         import_rules_button = QPushButton('导入规则')
         import_rules_button.clicked.connect(self.import_rules)
         export_rules_button = QPushButton('导出规则')
@@ -324,6 +2469,7 @@ class MultiFormatReplacerApp(QMainWindow):
         rules_buttons_layout.addWidget(remove_rule_button)
         rules_buttons_layout.addWidget(import_rules_button)
         rules_buttons_layout.addWidget(export_rules_button)
+        rules_buttons_layout.addWidget(rule_report_button)
         rules_layout.addLayout(rules_buttons_layout)
 
         right_splitter.addWidget(rules_widget)
@@ -334,13 +2480,68 @@ class MultiFormatReplacerApp(QMainWindow):
         self.max_workers_spinbox.setRange(1, os.cpu_count())
         self.max_workers_spinbox.setValue(os.cpu_count())
         concurrency_layout.addWidget(self.max_workers_spinbox)
+        self.auto_tune_checkbox = QCheckBox("自动调整")
+        self.auto_tune_checkbox.toggled.connect(lambda checked: self.max_workers_spinbox.setEnabled(not checked))
+        concurrency_layout.addWidget(self.auto_tune_checkbox)
+        self.use_index_checkbox = QCheckBox("使用全文索引跳过不含匹配文本的文件")
+        self.use_index_checkbox.setChecked(True)
+        concurrency_layout.addWidget(self.use_index_checkbox)
         rules_layout.addLayout(concurrency_layout)
 
+        # 输出目录选项
+        output_layout = QHBoxLayout()
+        self.output_dir_checkbox = QCheckBox("输出到其他文件夹（不修改原文件）")
+        output_layout.addWidget(self.output_dir_checkbox)
+        self.output_dir_edit = QLineEdit()
+        self.output_dir_edit.setPlaceholderText("输出文件夹")
+        output_layout.addWidget(self.output_dir_edit)
+        browse_output_button = QPushButton('选择...')
+        browse_output_button.clicked.connect(self.choose_output_dir)
+        output_layout.addWidget(browse_output_button)
+        self.unchanged_mode_combo = QComboBox()
+        self.unchanged_mode_combo.addItems(["未更改的文件创建硬链接", "跳过未更改的文件"])
+        output_layout.addWidget(self.unchanged_mode_combo)
+        rules_layout.addLayout(output_layout)
+
+        # 隔离处理选项：每个文件在独立子进程中处理，超时或超出内存时隔离该文件
+        isolation_layout = QHBoxLayout()
+        self.isolation_checkbox = QCheckBox("隔离处理每个文件")
+        self.isolation_checkbox.setChecked(True)
+        isolation_layout.addWidget(self.isolation_checkbox)
+        isolation_layout.addWidget(QLabel("单文件超时(秒):"))
+        self.timeout_spinbox = QSpinBox()
+        self.timeout_spinbox.setRange(5, 3600)
+        self.timeout_spinbox.setValue(120)
+        isolation_layout.addWidget(self.timeout_spinbox)
+        isolation_layout.addWidget(QLabel("内存上限(MB):"))
+        self.memory_limit_spinbox = QSpinBox()
+        self.memory_limit_spinbox.setRange(256, 65536)
+        self.memory_limit_spinbox.setValue(2048)
+        isolation_layout.addWidget(self.memory_limit_spinbox)
+        clear_quarantine_button = QPushButton('清除隔离列表')
+        clear_quarantine_button.clicked.connect(self.clear_quarantine)
+        isolation_layout.addWidget(clear_quarantine_button)
+        rules_layout.addLayout(isolation_layout)
+
+        # CSV/TSV 列限定：只替换表头中列出的列
+        csv_layout = QHBoxLayout()
+        csv_layout.addWidget(QLabel("CSV/TSV 仅替换这些列:"))
+        self.csv_columns_edit = QLineEdit()
+        self.csv_columns_edit.setPlaceholderText("留空表示所有列，多个列名用逗号分隔")
+        csv_layout.addWidget(self.csv_columns_edit)
+        rules_layout.addLayout(csv_layout)
+
         # 替换按钮
         replace_button = QPushButton('执行替换')
         replace_button.setIcon(QIcon(self.style().standardIcon(QStyle.StandardPixmap.SP_BrowserReload)))
         replace_button.clicked.connect(self.replace_text)
-        rules_layout.addWidget(replace_button)
+        scan_button = QPushButton('扫描预览（不修改文件）')
+        scan_button.setIcon(QIcon(self.style().standardIcon(QStyle.StandardPixmap.SP_FileDialogContentsView)))
+        scan_button.clicked.connect(self.scan_text)
+        action_buttons_layout = QHBoxLayout()
+        action_buttons_layout.addWidget(replace_button)
+        action_buttons_layout.addWidget(scan_button)
+        rules_layout.addLayout(action_buttons_layout)
 
         # 进度条
         self.progress_bar = QProgressBar()
@@ -383,6 +2584,11 @@ class MultiFormatReplacerApp(QMainWindow):
         undo_button.clicked.connect(self.undo_last_replacement)
         right_layout.addWidget(undo_button)
 
+        history_button = QPushButton('替换历史')
+        history_button.setIcon(QIcon(self.style().standardIcon(QStyle.StandardPixmap.SP_FileDialogListView)))
+        history_button.clicked.connect(self.show_history)
+        right_layout.addWidget(history_button)
+
         main_splitter.addWidget(right_panel)
 
         # 设置初始分割比例
@@ -572,7 +2778,8 @@ class MultiFormatReplacerApp(QMainWindow):
         os.startfile(os.path.dirname(file_path))
 
     def add_files(self):
-        files, _ = QFileDialog.getOpenFileNames(self, "选择文件", "", "所有支持的文件 (*.docx *.xlsx *.txt *.md)")
+        files, _ = QFileDialog.getOpenFileNames(self, "选择文件", "",
+                                                "所有支持的文件 (*.docx *.xlsx *.txt *.md *.csv *.tsv)")
         new_files = [file for file in files if file not in self.file_set]
         if new_files:
             self.file_list.addItems(new_files)
@@ -588,14 +2795,14 @@ class MultiFormatReplacerApp(QMainWindow):
             new_files = []
             for root, dirs, files in os.walk(folder):
                 for file in files:
-                    if file.endswith(('.docx', '.xlsx', '.txt', '.md')):
+                    if file.endswith(SUPPORTED_EXTENSIONS):
                         file_path = os.path.join(root, file)
                         if file_path not in self.file_set:
                             new_files.append(file_path)
                             self.file_set.add(file_path)
             self.file_list.addItems(new_files)
             self.log(f"已从文件夹添加 {len(new_files)} 个新文件。")
-            if len(new_files) < len([f for f in os.listdir(folder) if f.endswith(('.docx', '.xlsx', '.txt', '.md'))]):
+            if len(new_files) < len([f for f in os.listdir(folder) if f.endswith(SUPPORTED_EXTENSIONS)]):
                 self.log("部分文件因重复而被跳过。")
             self.update_file_list()
 
@@ -660,14 +2867,54 @@ class MultiFormatReplacerApp(QMainWindow):
                 self.rules_table.item(row, 0).setBackground(QColor(60, 60, 62) if self.is_dark_mode else QColor(255, 255, 255))
                 self.rules_table.item(row, 1).setBackground(QColor(60, 60, 62) if self.is_dark_mode else QColor(255, 255, 255))
 
-    def replace_text(self):
-        files = [self.file_list.item(i).text() for i in range(self.file_list.count())]
-        rules = []
+    def collect_rules(self):
+        pairs = []
         for row in range(self.rules_table.rowCount()):
             old_text = self.rules_table.item(row, 0).text().strip()
             new_text = self.rules_table.item(row, 1).text().strip()
             if old_text and new_text and old_text != new_text:
-                rules.append((old_text, new_text))
+                pairs.append((old_text, new_text))
+        return load_rule_set(pairs)
+
+    def scan_text(self):
+        if self.scan_worker is not None and self.scan_worker.isRunning():
+            self.show_styled_message_box("提示", "扫描正在进行，请等待当前扫描完成。", QMessageBox.Icon.Information)
+            return
+        files = [self.file_list.item(i).text() for i in range(self.file_list.count())]
+        rules = self.collect_rules()
+
+        if not files or not rules:
+            self.show_styled_message_box("警告", "请添加文件和有效的替换规则。", QMessageBox.Icon.Warning)
+            return
+
+        self.log(f"开始扫描：{len(files)} 个文件，{len(rules)} 条规则，不会修改任何文件。")
+        self.log_rule_conflicts(rules)
+
+        max_workers = self.max_workers_spinbox.value()
+        corpus_index = self.get_corpus_index() if self.use_index_checkbox.isChecked() else None
+        self.scan_worker = ReplacementWorker(files, rules, None, max_workers, corpus_index, dry_run=True,
+                                             isolation=self.isolation_settings(),
+                                             auto_tune=self.auto_tune_checkbox.isChecked(),
+                                             csv_columns=self.csv_columns())
+        self.scan_dialog = ScanResultsDialog(rules, self)
+        self.scan_worker.progress.connect(self.update_progress)
+        self.scan_worker.file_quarantined.connect(self.file_quarantined)
+        self.scan_worker.file_failed.connect(self.file_failed)
+        self.scan_worker.file_scanned.connect(self.scan_dialog.add_file_result)
+        self.scan_worker.finished.connect(self.scan_dialog.scan_finished)
+        self.scan_worker.finished.connect(self.scan_finished)
+        self.scan_dialog.show()
+        self.scan_worker.start()
+
+    def scan_finished(self, stats):
+        self.progress_bar.setValue(100)
+        self.last_rule_report = (self.scan_worker.rules, stats)
+        self.log_concurrency(stats)
+        self.log(f"扫描完成：{stats['changed_files']} 个文件共有 {stats['total_replacements']} 处匹配。")
+
+    def replace_text(self):
+        files = [self.file_list.item(i).text() for i in range(self.file_list.count())]
+        rules = self.collect_rules()
 
         if not files or not rules:
             self.show_styled_message_box("警告", "请添加文件和有效的替换规则。", QMessageBox.Icon.Warning)
@@ -679,15 +2926,36 @@ class MultiFormatReplacerApp(QMainWindow):
         if confirm == QMessageBox.StandardButton.No:
             return
 
-        backup_dir = os.path.join(self.temp_dir, f'backup_{len(self.replacement_history)}')
-        os.makedirs(backup_dir, exist_ok=True)
+        output_dir = source_root = None
+        if self.output_dir_checkbox.isChecked():
+            output_dir, source_root = self.resolve_output_dir(files)
+            if not output_dir:
+                return
+            backup_dir = None
+            journal = run_id = None
+        else:
+            # 备份只在处理期间保留，差异写入撤销记录后即删除
+            backup_dir = tempfile.mkdtemp(prefix='backup_', dir=self.temp_dir)
+            journal = self.get_journal()
+            run_id = journal.start_run(rules) if journal else None
 
         self.log(f"开始替换操作：处理 {len(files)} 个文件，应用 {len(rules)} 条规则。")
+        if output_dir:
+            self.log(f"结果将写入 {output_dir}（保持相对于 {source_root} 的目录结构），原文件不会被修改。")
+        self.log_rule_conflicts(rules)
 
         max_workers = self.max_workers_spinbox.value()
-        self.worker = ReplacementWorker(files, rules, backup_dir, max_workers)
+        corpus_index = self.get_corpus_index() if self.use_index_checkbox.isChecked() else None
+        self.worker = ReplacementWorker(files, rules, backup_dir, max_workers, corpus_index,
+                                        output_dir=output_dir, source_root=source_root,
+                                        link_unchanged=self.unchanged_mode_combo.currentIndex() == 0,
+                                        isolation=self.isolation_settings(),
+                                        auto_tune=self.auto_tune_checkbox.isChecked(),
+                                        csv_columns=self.csv_columns(), journal=journal, run_id=run_id)
         self.worker.progress.connect(self.update_progress)
         self.worker.file_processed.connect(self.update_output)
+        self.worker.file_quarantined.connect(self.file_quarantined)
+        self.worker.file_failed.connect(self.file_failed)
         self.worker.finished.connect(self.replacement_finished)
 
         self.loading_dialog = LoadingDialog(self)
@@ -696,7 +2964,129 @@ class MultiFormatReplacerApp(QMainWindow):
 
         self.worker.start()
 
-        self.replacement_history.append((files, rules, backup_dir))
+    def log_concurrency(self, stats):
+        if not self.auto_tune_checkbox.isChecked():
+            return
+        concurrency = stats["concurrency"]
+        source = "测量后已保存，下次处理同类文件时直接使用" if concurrency["tuned"] else "使用已保存或默认的设置"
+        self.log(f"并发数：I/O {concurrency['io']}，处理 {concurrency['cpu']}（{source}）。")
+
+    def csv_columns(self):
+        names = {name.strip() for name in re.split(r'[,，]', self.csv_columns_edit.text()) if name.strip()}
+        return names or None
+
+    def isolation_settings(self):
+        if not self.isolation_checkbox.isChecked():
+            return None
+        return self.timeout_spinbox.value(), self.memory_limit_spinbox.value() * 1024 * 1024
+
+    def file_quarantined(self, file_path, reason):
+        self.log(f"{file_path}: 已隔离，{reason}")
+
+    def file_failed(self, file_path, error):
+        self.log(f"{file_path}: 处理失败，{error}")
+
+    def clear_quarantine(self):
+        count = len(load_quarantine())
+        try:
+            if os.path.exists(QUARANTINE_PATH):
+                os.remove(QUARANTINE_PATH)
+        except OSError as e:
+            self.log(f"清除隔离列表失败: {str(e)}")
+            return
+        self.log(f"已清除隔离列表中的 {count} 个文件。")
+
+    def choose_output_dir(self):
+        folder = QFileDialog.getExistingDirectory(self, "选择输出文件夹")
+        if folder:
+            self.output_dir_edit.setText(folder)
+            self.output_dir_checkbox.setChecked(True)
+
+    def resolve_output_dir(self, files):
+        output_dir = self.output_dir_edit.text().strip()
+        if not output_dir:
+            self.choose_output_dir()
+            output_dir = self.output_dir_edit.text().strip()
+            if not output_dir:
+                return None, None
+        try:
+            source_root = os.path.commonpath([os.path.dirname(os.path.abspath(f)) for f in files])
+        except ValueError:
+            self.show_styled_message_box("警告", "文件位于不同的磁盘上，无法映射到同一个输出文件夹。", QMessageBox.Icon.Warning)
+            return None, None
+        output_dir = os.path.abspath(output_dir)
+        if os.path.commonpath([os.path.realpath(output_dir), os.path.realpath(source_root)]) == \
+                os.path.realpath(source_root):
+            self.show_styled_message_box("警告", "输出文件夹不能是源文件夹或其子文件夹。", QMessageBox.Icon.Warning)
+            return None, None
+        # 输出路径不能与任何待处理的文件重合，否则会覆盖其他源文件
+        sources = {os.path.realpath(f) for f in files}
+        for f in files:
+            target = os.path.join(output_dir, os.path.relpath(os.path.abspath(f), source_root))
+            if os.path.realpath(target) in sources:
+                self.show_styled_message_box("警告", f"输出路径与源文件重合：{target}", QMessageBox.Icon.Warning)
+                return None, None
+        return output_dir, source_root
+
+    def fan_out_template(self):
+        template_path, _ = QFileDialog.getOpenFileName(self, "选择模板文件", "", "所有支持的文件 (*.docx *.xlsx *.txt *.md)")
+        if not template_path:
+            return
+        data_path, _ = QFileDialog.getOpenFileName(self, "选择数据表（第一行为占位符）", "", "数据表 (*.csv *.tsv *.txt)")
+        if not data_path:
+            return
+        output_dir = QFileDialog.getExistingDirectory(self, "选择输出文件夹")
+        if not output_dir:
+            return
+
+        self.log(f"开始模板批量生成：模板 {template_path}，数据表 {data_path}，输出到 {output_dir}")
+        self.fan_out_worker = FanOutWorker(template_path, data_path, output_dir, self.max_workers_spinbox.value())
+        self.fan_out_worker.progress.connect(self.update_progress)
+        self.fan_out_worker.file_generated.connect(self.fan_out_file_generated)
+        self.fan_out_worker.finished.connect(self.fan_out_finished)
+
+        self.loading_dialog = LoadingDialog(self)
+        self.fan_out_worker.progress.connect(self.loading_dialog.update_progress)
+        self.loading_dialog.show()
+
+        self.fan_out_worker.start()
+
+    def fan_out_file_generated(self, output_path, success):
+        if not success:
+            self.log(f"{output_path}: 生成失败")
+
+    def fan_out_finished(self, stats):
+        self.loading_dialog.close()
+        self.progress_bar.setValue(100)
+        if stats["error"]:
+            self.log(f"模板批量生成失败: {stats['error']}")
+            self.show_styled_message_box("生成失败", f"模板批量生成失败: {stats['error']}", QMessageBox.Icon.Warning)
+            return
+        self.log(f"模板批量生成完成：成功 {stats['generated_files']} 个，失败 {stats['failed_files']} 个。")
+        summary = (f"模板批量生成摘要:\n"
+                   f"数据行数: {stats['total_rows']}\n"
+                   f"生成文件数: {stats['generated_files']}\n"
+                   f"失败文件数: {stats['failed_files']}")
+        self.show_styled_message_box("生成完成", summary, QMessageBox.Icon.Information)
+
+    def get_journal(self):
+        if self.journal is None:
+            try:
+                self.journal = UndoJournal()
+            except (OSError, sqlite3.Error) as e:
+                self.log(f"无法打开撤销记录，本次替换将无法撤销: {str(e)}")
+                return None
+        return self.journal
+
+    def get_corpus_index(self):
+        if self.corpus_index is None:
+            try:
+                self.corpus_index = CorpusIndex()
+            except (OSError, sqlite3.Error) as e:
+                self.log(f"无法打开全文索引，将处理全部文件: {str(e)}")
+                return None
+        return self.corpus_index
+
     def update_progress(self, value):
         if self.progress_bar.value() < value:
             animation = QPropertyAnimation(self.progress_bar, b"value")
@@ -742,67 +3132,150 @@ class MultiFormatReplacerApp(QMainWindow):
         self.loading_dialog.close()
         self.log("替换操作完成。")
         self.progress_bar.setValue(100)
+        self.last_rule_report = (self.worker.rules, stats)
+        self.log_concurrency(stats)
+        if stats["skipped_files"]:
+            self.log(f"全文索引显示 {stats['skipped_files']} 个文件不含任何匹配文本，已跳过。")
+        if stats["deduplicated_files"]:
+            self.log(f"{stats['deduplicated_files']} 个文件与其他文件内容相同，直接复制处理结果，"
+                     f"节省处理 {stats['deduplicated_bytes'] / 1024 / 1024:.1f} MB。")
+        dead_rules = len(self.worker.rules) - len(stats["rule_hits"])
+        if dead_rules:
+            self.log(f"有 {dead_rules} 条规则未命中任何文件，可在“规则报告”中查看并移除。")
 
         summary = (f"替换操作摘要:\n"
                    f"处理文件总数: {stats['total_files']}\n"
+                   f"跳过的文件数: {stats['skipped_files']}\n"
+                   f"重复文件（直接复制结果）: {stats['deduplicated_files']}\n"
+                   f"已隔离的文件数: {len(stats['quarantined'])}\n"
                    f"发生更改的文件数: {stats['changed_files']}\n"
                    f"总替换次数: {stats['total_replacements']}")
 
         self.show_styled_message_box("替换完成", summary, QMessageBox.Icon.Information)
 
+    def show_rule_report(self):
+        if not self.last_rule_report:
+            self.show_styled_message_box("提示", "请先执行一次替换操作。", QMessageBox.Icon.Information)
+            return
+        rule_set, stats = self.last_rule_report
+        dialog = RuleReportDialog(rule_set, stats, self)
+        if dialog.exec() == QDialog.DialogCode.Accepted:
+            dead_rules = set(dialog.dead_rules())
+            for row in reversed(range(self.rules_table.rowCount())):
+                if self.rules_table.item(row, 0).text().strip() in dead_rules:
+                    self.rules_table.removeRow(row)
+            self.validate_rules()
+            self.log(f"已移除 {len(dead_rules)} 条未命中的规则。")
+
     def undo_last_replacement(self):
-        if not self.replacement_history:
+        journal = self.get_journal()
+        run_id = journal.latest_run() if journal else None
+        if run_id is None:
             self.show_styled_message_box("提示", "没有可撤销的操作。", QMessageBox.Icon.Information)
             return
 
-        files, rules, backup_dir = self.replacement_history.pop()
-        confirm = self.show_styled_message_box('确认', f'是否撤销上次替换操作？\n文件数：{len(files)}\n规则数：{len(rules)}',
+        run = next(run for run in journal.runs() if run[0] == run_id)
+        confirm = self.show_styled_message_box('确认', f'是否撤销上次替换操作？\n时间：{run[1]}\n'
+                                                     f'文件数：{run[3]}\n规则数：{len(run[2])}',
                                                QMessageBox.Icon.Question,
                                                QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No)
         if confirm == QMessageBox.StandardButton.No:
             return
+        self.start_restore(run_id, True)
 
-        self.log("开始撤销上次替换操作...")
-        for file_path in files:
-            backup_path = os.path.join(backup_dir, os.path.basename(file_path))
-            if os.path.exists(backup_path):
-                try:
-                    shutil.copy2(backup_path, file_path)
-                    self.log(f"已恢复文件: {file_path}")
-                except Exception as e:
-                    self.log(f"恢复文件失败: {file_path}, 错误: {str(e)}")
-            else:
-                self.log(f"未找到备份文件: {file_path}")
+    def show_history(self):
+        journal = self.get_journal()
+        if journal is None:
+            return
+        dialog = JournalDialog(journal, self)
+        if dialog.exec() == QDialog.DialogCode.Accepted and dialog.selected:
+            self.start_restore(*dialog.selected)
+
+    def start_restore(self, run_id, undo):
+        action = "撤销" if undo else "重做"
+        self.log(f"开始{action}第 {run_id} 次替换操作...")
+        self.restore_worker = RestoreWorker(self.journal, run_id, undo, self.max_workers_spinbox.value())
+        self.restore_worker.progress.connect(self.update_progress)
+        self.restore_worker.file_restored.connect(self.file_restored)
+        self.restore_worker.finished.connect(self.restore_finished)
+        self.loading_dialog = LoadingDialog(self)
+        self.restore_worker.progress.connect(self.loading_dialog.update_progress)
+        self.loading_dialog.show()
+        self.restore_worker.start()
 
-        self.log("撤销操作完成。")
-        self.show_styled_message_box("撤销完成", "已成功撤销上次替换操作。", QMessageBox.Icon.Information)
+    def file_restored(self, file_path, restored, error):
+        if restored:
+            self.log(f"已恢复文件: {file_path}")
+        else:
+            self.log(f"恢复文件失败: {file_path}, 错误: {error}")
+
+    def restore_finished(self, stats):
+        self.loading_dialog.close()
+        self.progress_bar.setValue(100)
+        action = "撤销" if self.restore_worker.undo else "重做"
+        self.log(f"{action}操作完成。")
+        if stats["failed_files"]:
+            self.show_styled_message_box(f"{action}完成",
+                                         f"已恢复 {stats['restored_files']} 个文件，"
+                                         f"{stats['failed_files']} 个文件未能恢复，详见日志。",
+                                         QMessageBox.Icon.Warning)
+        else:
+            self.show_styled_message_box(f"{action}完成", f"已成功{action} {stats['restored_files']} 个文件。",
+                                         QMessageBox.Icon.Information)
+
+    def schedule_preview(self, *args):
+        self.preview_timer.start(300)
 
     def update_preview(self):
+        # 取消仍在进行的预览，在后台重新提取文本并高亮当前规则的匹配
+        self.preview_timer.stop()
+        self.preview_generation += 1
+        if self.preview_worker is not None:
+            self.preview_worker.cancel()
+            self.preview_worker = None
+
         selected_items = self.file_list.selectedItems()
         if not selected_items:
             self.preview_area.clear()
             return
 
         file_path = selected_items[0].text()
-        file_extension = os.path.splitext(file_path)[1].lower()
+        pairs = []
+        for row in range(self.rules_table.rowCount()):
+            old_item, new_item = self.rules_table.item(row, 0), self.rules_table.item(row, 1)
+            if old_item is not None and new_item is not None:
+                pairs.append((old_item.text(), new_item.text()))
 
         try:
-            if file_extension == '.docx':
-                doc = Document(file_path)
-                preview_text = '\n'.join([para.text for para in doc.paragraphs[:20]])
-            elif file_extension == '.xlsx':
-                wb = openpyxl.load_workbook(file_path, read_only=True)
-                sheet = wb.active
-                preview_text = '\n'.join([', '.join(str(cell.value) for cell in row) for row in sheet.iter_rows(max_row=20)])
-            elif file_extension in ['.txt', '.md']:
-                with open(file_path, 'r', encoding='utf-8') as file:
-                    preview_text = file.read(2000)  # Read first 2000 characters
-            else:
-                preview_text = "不支持的文件类型"
-
-            self.preview_area.setText(preview_text)
-        except Exception as e:
-            self.preview_area.setText(f"无法预览文件: {str(e)}")
+            stat = os.stat(file_path)
+            cached = self.preview_texts.get(file_path)
+            text = cached[2] if cached and cached[:2] == (stat.st_mtime, stat.st_size) else None
+        except OSError:
+            text = None
+
+        worker = PreviewWorker(self.preview_generation, file_path, pairs, text, self.corpus_index)
+        worker.preview_ready.connect(self.preview_ready)
+        # 被取消的线程结束前需要保留引用
+        worker.finished.connect(lambda: self.preview_workers.discard(worker))
+        self.preview_workers.add(worker)
+        self.preview_worker = worker
+        worker.start()
+
+    def preview_ready(self, generation, file_path, text, preview_html):
+        if generation != self.preview_generation:
+            return
+        self.preview_worker = None
+        try:
+            if not text:
+                raise OSError
+            stat = os.stat(file_path)
+            self.preview_texts.pop(file_path, None)
+            self.preview_texts[file_path] = (stat.st_mtime, stat.st_size, text)
+            while len(self.preview_texts) > PREVIEW_CACHE_SIZE:
+                self.preview_texts.pop(next(iter(self.preview_texts)))
+        except OSError:
+            pass
+        self.preview_area.setHtml(preview_html)
 
     def import_rules(self):
         file_name, _ = QFileDialog.getOpenFileName(self, "导入规则", "", "JSON Files (*.json)")
@@ -830,9 +3303,20 @@ class MultiFormatReplacerApp(QMainWindow):
                     self.add_rule(old_text, new_text)
 
                 self.log(f"已从 {file_name} 导入并合并 {len(imported_rules)} 条规则")
+                # 预先编译合并后的规则集，之后开始替换时直接从缓存映射
+                self.log_rule_conflicts(self.collect_rules())
             except Exception as e:
                 self.show_styled_message_box("导入失败", f"导入规则失败: {str(e)}", QMessageBox.Icon.Warning)
 
+    def log_rule_conflicts(self, rule_set, limit=20):
+        if not rule_set.conflicts:
+            return
+        self.log(f"规则集存在 {len(rule_set.conflicts)} 处冲突：")
+        for conflict in rule_set.conflicts[:limit]:
+            self.log(f"  {rule_set.describe_conflict(conflict)}")
+        if len(rule_set.conflicts) > limit:
+            self.log(f"  其余 {len(rule_set.conflicts) - limit} 处冲突未显示")
+
     def export_rules(self):
         rules = []
         for row in range(self.rules_table.rowCount()):
@@ -868,12 +3352,12 @@ class MultiFormatReplacerApp(QMainWindow):
             if os.path.isdir(file):
                 for root, dirs, files in os.walk(file):
                     for f in files:
-                        if f.endswith(('.docx', '.xlsx', '.txt', '.md')):
+                        if f.endswith(SUPPORTED_EXTENSIONS):
                             file_path = os.path.join(root, f)
                             if file_path not in self.file_set:
                                 new_files.append(file_path)
                                 self.file_set.add(file_path)
-            elif file.endswith(('.docx', '.xlsx', '.txt', '.md')) and file not in self.file_set:
+            elif file.endswith(SUPPORTED_EXTENSIONS) and file not in self.file_set:
                 new_files.append(file)
                 self.file_set.add(file)
 
@@ -960,6 +3444,8 @@ class MultiFormatReplacerApp(QMainWindow):
         super().closeEvent(event)
 
 if __name__ == '__main__':
+    # 打包后的程序启动隔离处理子进程时需要
+    multiprocessing.freeze_support()
     app = QApplication(sys.argv)
     app.setStyle(QStyleFactory.create('Fusion'))
     ex = MultiFormatReplacerApp()